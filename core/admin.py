@@ -26,7 +26,7 @@ class UserAdmin(admin.ModelAdmin):
     change_user_password_template = None
     fieldsets = (
         (None, {'fields': ('username', 'password')}),
-        ('PGP', {'fields': ('pgp_public', 'pgp_private', 'two_factor_auth')}),
+        ('PGP', {'fields': ('pgp_public', 'pgp_fingerprint', 'pgp_key_id', 'pgp_algorithm', 'pgp_expires_at', 'pgp_private', 'two_factor_auth')}),
         (_('Permissions'), {
             'fields': ('is_active', 'is_staff', 'is_superuser', 'groups', 'user_permissions'),
         }),
@@ -43,9 +43,10 @@ class UserAdmin(admin.ModelAdmin):
     change_password_form = AdminPasswordChangeForm
     list_display = ('username',  'is_staff')
     list_filter = ('is_staff', 'is_superuser', 'is_active', 'groups')
-    search_fields = ('username', )
+    search_fields = ('username', 'pgp_fingerprint', 'pgp_key_id')
     ordering = ('username',)
     filter_horizontal = ('groups', 'user_permissions',)
+    readonly_fields = ('pgp_fingerprint', 'pgp_key_id', 'pgp_algorithm', 'pgp_expires_at')
 
     def get_fieldsets(self, request, obj=None):
         if not obj:
@@ -0,0 +1,186 @@
+import copy
+import threading
+import time
+from collections import OrderedDict, defaultdict, namedtuple
+
+from django.conf import settings
+from django.core.cache import cache
+from django.utils.translation import gettext_lazy as _
+from rest_framework_simplejwt.authentication import JWTAuthentication
+from rest_framework_simplejwt.exceptions import InvalidToken, TokenError
+from rest_framework_simplejwt.settings import api_settings
+
+from core.tickets import WebsocketToken
+
+CachedToken = namedtuple(
+    'CachedToken', ('user', 'validated_token', 'deadline', 'shared_generation'))
+
+
+def generation_key(user_id):
+    return f'auth_generation:{user_id}'
+
+
+def get_shared_generation(user_id):
+    """
+    Invalidation count of a user shared by every process, through the cache.
+    """
+    return cache.get(generation_key(user_id), 0)
+
+
+def bump_shared_generation(user_id):
+    # Entries live at most JWT_CACHE_TTL: once the count expires, entries
+    # stored under a later one don't match 0 and are verified again
+    key = generation_key(user_id)
+    if not cache.add(key, 1, settings.JWT_CACHE_TTL):
+        try:
+            cache.incr(key)
+        except ValueError:
+            # Expired in between
+            cache.add(key, 1, settings.JWT_CACHE_TTL)
+
+
+class TokenCache:
+    """
+    In-process LRU of verified access tokens and the user they belong to.
+
+    An entry lives until its token expires, at most JWT_CACHE_TTL seconds.
+    It is dropped as soon as its user changes in this process, and isn't
+    used anymore once the shared generation of its user moved, when the
+    user changed in another process.
+    """
+
+    def __init__(self):
+        self.entries = OrderedDict()
+        # Raw tokens and invalidation count of each user
+        self.user_tokens = defaultdict(set)
+        self.generations = defaultdict(int)
+        self.lock = threading.Lock()
+
+    def get(self, raw_token):
+        with self.lock:
+            entry = self.entries.get(raw_token)
+            if entry is None:
+                return None
+            if entry.deadline <= time.time():
+                self.remove(raw_token)
+                return None
+            self.entries.move_to_end(raw_token)
+            return entry
+
+    def generation(self, user_id):
+        with self.lock:
+            return self.generations.get(user_id, 0)
+
+    def set(self, raw_token, user, validated_token, generation,
+            shared_generation):
+        """
+        Cache a verified token, unless its user changed since `generation`
+        was read, before the user was loaded.
+        """
+        deadline = min(validated_token['exp'],
+                       time.time() + settings.JWT_CACHE_TTL)
+        with self.lock:
+            if self.generations.get(user.pk, 0) != generation:
+                return
+            self.entries[raw_token] = CachedToken(
+                user, validated_token, deadline, shared_generation)
+            self.entries.move_to_end(raw_token)
+            self.user_tokens[user.pk].add(raw_token)
+            while len(self.entries) > settings.JWT_CACHE_SIZE:
+                self.remove(next(iter(self.entries)))
+
+    def remove(self, raw_token):
+        entry = self.entries.pop(raw_token)
+        tokens = self.user_tokens[entry.user.pk]
+        tokens.discard(raw_token)
+        if not tokens:
+            del self.user_tokens[entry.user.pk]
+
+    def discard(self, raw_token):
+        with self.lock:
+            if raw_token in self.entries:
+                self.remove(raw_token)
+
+    def forget_user(self, user_id):
+        with self.lock:
+            self.generations[user_id] += 1
+            for raw_token in self.user_tokens.pop(user_id, ()):
+                del self.entries[raw_token]
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.user_tokens.clear()
+            self.generations.clear()
+
+
+token_cache = TokenCache()
+
+
+class CachedJWTAuthentication(JWTAuthentication):
+    """
+    JWTAuthentication skipping the signature check and the user query for
+    tokens verified recently by this process.
+    """
+    # Kind of token authenticated, kept apart in the cache
+    token_type = 'access'
+
+    def authenticate(self, request):
+        header = self.get_header(request)
+        if header is None:
+            return None
+
+        raw_token = self.get_raw_token(header)
+        if raw_token is None:
+            return None
+
+        return self.authenticate_token(raw_token)
+
+    def authenticate_token(self, raw_token):
+        """
+        Return the user and the validated token of a raw token.
+        """
+        if isinstance(raw_token, str):
+            raw_token = raw_token.encode('utf-8')
+        key = (self.token_type, raw_token)
+
+        entry = token_cache.get(key)
+        if (entry is not None and entry.shared_generation !=
+                get_shared_generation(entry.user.pk)):
+            token_cache.discard(key)
+            entry = None
+        if entry is None:
+            validated_token = self.get_validated_token(raw_token)
+            try:
+                user_id = validated_token[api_settings.USER_ID_CLAIM]
+            except KeyError:
+                raise InvalidToken(
+                    _('Token contained no recognizable user identification'))
+            generation = token_cache.generation(user_id)
+            shared_generation = get_shared_generation(user_id)
+            user = self.get_user(validated_token)
+            # Requests may change their user: each gets its own copy
+            token_cache.set(key, copy.copy(user), validated_token,
+                            generation, shared_generation)
+            return user, validated_token
+
+        return copy.copy(entry.user), entry.validated_token
+
+
+class WebsocketTokenAuthentication(CachedJWTAuthentication):
+    """
+    Authentication of websocket connections with a WebsocketToken, access
+    tokens being refused.
+    """
+    token_type = 'websocket'
+
+    def get_validated_token(self, raw_token):
+        try:
+            return WebsocketToken(raw_token)
+        except TokenError as e:
+            raise InvalidToken({
+                'detail': _('Given token not valid for any token type'),
+                'messages': [{'token_class': WebsocketToken.__name__,
+                              'token_type': WebsocketToken.token_type,
+                              'message': e.args[0]}],
+            })
@@ -0,0 +1,81 @@
+"""
+Password hashing off the request threads.
+
+Hashes run in a bounded pool of PASSWORD_HASHING_CONCURRENCY threads (the
+Argon2 and PBKDF2 implementations release the GIL), so registration and
+login bursts can't take more than that many cores, nor that many Argon2
+memory buffers, away from the websocket workers. The calling thread waits
+for its hash: the pool bounds concurrency, it doesn't make hashing faster.
+"""
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+from django.contrib.auth import hashers
+from django.core.signals import setting_changed
+from django.dispatch import receiver
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def get_executor():
+    """
+    Return the hashing pool, or None if hashes run inline
+    (PASSWORD_HASHING_CONCURRENCY = 0).
+    """
+    global _executor
+    if not settings.PASSWORD_HASHING_CONCURRENCY:
+        return None
+    if _executor is None:
+        with _executor_lock:
+            if _executor is None:
+                _executor = ThreadPoolExecutor(
+                    max_workers=settings.PASSWORD_HASHING_CONCURRENCY,
+                    thread_name_prefix='password-hashing'
+                )
+    return _executor
+
+
+@receiver(setting_changed)
+def reset_executor(*, setting, **kwargs):
+    global _executor
+    if setting == 'PASSWORD_HASHING_CONCURRENCY' and _executor is not None:
+        _executor.shutdown(wait=False)
+        _executor = None
+
+
+def run(func, *args):
+    executor = get_executor()
+    if executor is None:
+        return func(*args)
+    return executor.submit(func, *args).result()
+
+
+def must_update(encoded):
+    """
+    Whether a valid hash was made by another hasher than the preferred one,
+    or with outdated parameters.
+    """
+    preferred = hashers.get_hasher('default')
+    hasher = hashers.identify_hasher(encoded)
+    return (hasher.algorithm != preferred.algorithm or
+            preferred.must_update(encoded))
+
+
+def hash_password(password, salt=None, hasher='default'):
+    return run(hashers.make_password, password, salt, hasher)
+
+
+def check_password(password, encoded, setter=None):
+    """
+    Check a password like django.contrib.auth.hashers.check_password. The
+    setter runs in the calling thread, as it usually saves the new hash.
+    """
+    if password is None or not hashers.is_password_usable(encoded):
+        return False
+
+    is_correct = run(hashers.check_password, password, encoded)
+    if is_correct and setter is not None and must_update(encoded):
+        setter(password)
+    return is_correct
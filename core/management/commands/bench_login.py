@@ -0,0 +1,118 @@
+import asyncio
+import statistics
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from uuid import uuid4
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import connection
+from django.test import override_settings
+from rest_framework_simplejwt.serializers import TokenObtainPairSerializer
+
+from core.hashing import hash_password
+from core.models import User
+
+PASSWORD = 'bench-password'
+
+
+class LoopLag:
+    """
+    Largest delay of a 1ms ticker running in its own event loop, standing
+    for the websocket handling of the worker.
+    """
+
+    def __init__(self):
+        self.max_lag = 0
+        self.running = True
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self.loop.run_forever)
+
+    async def tick(self):
+        while self.running:
+            before = time.perf_counter()
+            await asyncio.sleep(0.001)
+            self.max_lag = max(self.max_lag,
+                               time.perf_counter() - before - 0.001)
+
+    def __enter__(self):
+        self.thread.start()
+        self.ticker = asyncio.run_coroutine_threadsafe(self.tick(), self.loop)
+        return self
+
+    def __exit__(self, *exc_info):
+        self.running = False
+        self.ticker.result()
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+        self.loop.close()
+
+
+class Command(BaseCommand):
+    help = ('Measure how many logins per second one worker handles, with '
+            'password hashes run inline or in the hashing pool')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--users', type=int, default=20)
+        parser.add_argument('--logins', type=int, default=200,
+                            help='Logins per run')
+        parser.add_argument('--clients', type=int, default=16,
+                            help='Concurrent request threads')
+
+    def handle(self, *args, **options):
+        suffix = uuid4().hex[:8]
+        usernames = [f'bench-{suffix}-{i}' for i in range(options['users'])]
+        runs = (
+            ('inline', 0),
+            (f'pool ({settings.PASSWORD_HASHING_CONCURRENCY} threads)',
+             settings.PASSWORD_HASHING_CONCURRENCY),
+        )
+        try:
+            for name, concurrency in runs:
+                with override_settings(
+                        PASSWORD_HASHING_CONCURRENCY=concurrency):
+                    # Outdated hashes, upgraded by the first logins
+                    self.create_users(usernames)
+                    rehash = self.run(usernames, len(usernames), options)
+                    login = self.run(usernames, options['logins'], options)
+                self.stdout.write(f'{name}:')
+                self.report('  first logins (rehash)', *rehash)
+                self.report('  logins', *login)
+        finally:
+            User.objects.filter(username__in=usernames).delete()
+
+    def create_users(self, usernames):
+        User.objects.filter(username__in=usernames).delete()
+        password = hash_password(PASSWORD, hasher='pbkdf2_sha256')
+        User.objects.bulk_create(
+            User(username=username, password=password, pgp_public='bench')
+            for username in usernames
+        )
+
+    def login(self, username):
+        start = time.perf_counter()
+        try:
+            serializer = TokenObtainPairSerializer(
+                data={'username': username, 'password': PASSWORD})
+            serializer.is_valid(raise_exception=True)
+        finally:
+            connection.close()
+        return time.perf_counter() - start
+
+    def run(self, usernames, count, options):
+        logins = [usernames[i % len(usernames)] for i in range(count)]
+        with LoopLag() as lag, \
+                ThreadPoolExecutor(options['clients']) as clients:
+            start = time.perf_counter()
+            latencies = sorted(clients.map(self.login, logins))
+            elapsed = time.perf_counter() - start
+        return count / elapsed, latencies, lag.max_lag
+
+    def report(self, name, rate, latencies, lag):
+        p99 = latencies[min(len(latencies) - 1, int(len(latencies) * 0.99))]
+        self.stdout.write(
+            '%-24s %7.1f logins/s   p50 %6.1f ms   p99 %6.1f ms   '
+            'max loop lag %6.1f ms' % (
+                name, rate, statistics.median(latencies) * 1000,
+                p99 * 1000, lag * 1000))
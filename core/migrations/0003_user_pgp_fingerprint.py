@@ -0,0 +1,32 @@
+# Generated by Django 3.2 on 2026-10-18 08:42
+
+import hashlib
+
+from django.db import migrations, models
+
+
+def compute_fingerprints(apps, schema_editor):
+    User = apps.get_model('core', 'User')
+    users = list(User.objects.only('id', 'pgp_public'))
+    for user in users:
+        lines = user.pgp_public.strip().splitlines()
+        armored = '\n'.join(line.rstrip() for line in lines)
+        user.pgp_fingerprint = hashlib.sha256(
+            armored.encode('utf-8')).hexdigest()
+    User.objects.bulk_update(users, ['pgp_fingerprint'], batch_size=500)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0002_auto_20210409_2016'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='user',
+            name='pgp_fingerprint',
+            field=models.CharField(db_index=True, default='', editable=False, max_length=64),
+        ),
+        migrations.RunPython(compute_fingerprints, migrations.RunPython.noop),
+    ]
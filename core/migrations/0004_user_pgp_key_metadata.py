@@ -0,0 +1,384 @@
+# Generated by Django 3.2 on 2026-10-18 08:44
+
+import base64
+import binascii
+import hashlib
+import struct
+from collections import namedtuple
+from datetime import datetime, timedelta, timezone
+
+import core.keys
+from django.db import migrations, models
+
+# Frozen copy of the key parser of core.keys, so that this migration indexes
+# keys the same way whatever that module becomes.
+
+PUBLIC_KEY_TAG = 6
+SIGNATURE_TAG = 2
+USER_ID_TAG = 13
+PUBLIC_SUBKEY_TAG = 14
+
+# Certifications of user ids or attributes, and direct key signatures.
+# Only the ones issued by the primary key itself are self-signatures.
+CERTIFICATION_TYPES = {0x10, 0x11, 0x12, 0x13, 0x1F}
+CREATION_TIME_SUBPACKET = 2
+KEY_EXPIRATION_SUBPACKET = 9
+ISSUER_SUBPACKET = 16
+ISSUER_FINGERPRINT_SUBPACKET = 33
+
+ALGORITHMS = {
+    1: 'rsa',
+    2: 'rsa',
+    3: 'rsa',
+    16: 'elgamal',
+    17: 'dsa',
+    18: 'ecdh',
+    19: 'ecdsa',
+    22: 'eddsa',
+    25: 'x25519',
+    26: 'x448',
+    27: 'ed25519',
+    28: 'ed448',
+}
+# Algorithms whose key material starts with an MPI giving the key size
+MPI_ALGORITHMS = {1, 2, 3, 16, 17}
+# Algorithms whose key material starts with a curve OID
+CURVE_ALGORITHMS = {18, 19, 22}
+CURVES = {
+    bytes.fromhex('2a8648ce3d030107'): 'nistp256',
+    bytes.fromhex('2b81040022'): 'nistp384',
+    bytes.fromhex('2b81040023'): 'nistp521',
+    bytes.fromhex('2b2403030208010107'): 'brainpoolP256r1',
+    bytes.fromhex('2b240303020801010b'): 'brainpoolP384r1',
+    bytes.fromhex('2b240303020801010d'): 'brainpoolP512r1',
+    bytes.fromhex('2b06010401da470f01'): 'ed25519',
+    bytes.fromhex('2b060104019755010501'): 'cv25519',
+}
+
+PublicKey = namedtuple(
+    'PublicKey', ('fingerprint', 'key_id', 'algorithm', 'expires_at'))
+
+
+class InvalidKey(ValueError):
+    pass
+
+
+def crc24(data):
+    crc = 0xB704CE
+    for byte in data:
+        crc ^= byte << 16
+        for _ in range(8):
+            crc <<= 1
+            if crc & 0x1000000:
+                crc ^= 0x1864CFB
+    return crc & 0xFFFFFF
+
+
+def dearmor(armored):
+    """
+    Decode an ASCII armored public key block.
+    """
+    lines = [line.strip() for line in armored.strip().splitlines()]
+    try:
+        start = lines.index('-----BEGIN PGP PUBLIC KEY BLOCK-----')
+        end = lines.index('-----END PGP PUBLIC KEY BLOCK-----', start)
+    except ValueError:
+        raise InvalidKey('Not an armored PGP public key block')
+
+    body = lines[start + 1:end]
+    # Armor headers end with the first blank line
+    if '' in body:
+        body = body[body.index('') + 1:]
+    checksum = None
+    if body and body[-1].startswith('='):
+        checksum = body.pop()[1:]
+
+    try:
+        data = base64.b64decode(''.join(body), validate=True)
+        if checksum is not None:
+            expected = int.from_bytes(
+                base64.b64decode(checksum, validate=True), 'big')
+    except (binascii.Error, ValueError):
+        raise InvalidKey('Invalid base64 data')
+    if checksum is not None and crc24(data) != expected:
+        raise InvalidKey('Invalid armor checksum')
+    return data
+
+
+def read_packets(data):
+    """
+    Yield the `(tag, body)` packets of binary OpenPGP data.
+    """
+    offset = 0
+    while offset < len(data):
+        header = data[offset]
+        offset += 1
+        if not header & 0x80:
+            raise InvalidKey('Invalid packet header')
+
+        if header & 0x40:
+            # New format
+            tag = header & 0x3F
+            if offset >= len(data):
+                raise InvalidKey('Truncated packet header')
+            first = data[offset]
+            if first < 192:
+                length, size = first, 1
+            elif first < 224:
+                if offset + 1 >= len(data):
+                    raise InvalidKey('Truncated packet header')
+                length = ((first - 192) << 8) + data[offset + 1] + 192
+                size = 2
+            elif first == 255:
+                if offset + 5 > len(data):
+                    raise InvalidKey('Truncated packet header')
+                length, = struct.unpack_from('>I', data, offset + 1)
+                size = 5
+            else:
+                raise InvalidKey('Partial lengths are invalid in keys')
+        else:
+            # Old format
+            tag = (header >> 2) & 0x0F
+            length_type = header & 0x03
+            if length_type == 3:
+                length, size = len(data) - offset, 0
+            else:
+                size = 1 << length_type
+                if offset + size > len(data):
+                    raise InvalidKey('Truncated packet header')
+                length = int.from_bytes(data[offset:offset + size], 'big')
+
+        offset += size
+        if offset + length > len(data):
+            raise InvalidKey('Truncated packet')
+        yield tag, data[offset:offset + length]
+        offset += length
+
+
+def mpi_bits(material):
+    if len(material) < 2:
+        raise InvalidKey('Truncated key material')
+    return struct.unpack_from('>H', material)[0]
+
+
+def algorithm_name(algorithm, material):
+    name = ALGORITHMS.get(algorithm)
+    if name is None:
+        raise InvalidKey(f'Unknown public key algorithm {algorithm}')
+    if algorithm in MPI_ALGORITHMS:
+        return f'{name}{mpi_bits(material)}'
+    if algorithm in CURVE_ALGORITHMS:
+        if not material or len(material) < 1 + material[0]:
+            raise InvalidKey('Truncated key material')
+        oid = bytes(material[1:1 + material[0]])
+        return f"{name}-{CURVES.get(oid, oid.hex())}"
+    return name
+
+
+def parse_key_packet(body):
+    """
+    Return the fingerprint, key id, algorithm and creation time of a public
+    key packet.
+    """
+    if len(body) < 6:
+        raise InvalidKey('Truncated public key packet')
+    version = body[0]
+    created, = struct.unpack_from('>I', body, 1)
+    if version == 4:
+        material = body[6:]
+        digest = hashlib.sha1(
+            b'\x99' + struct.pack('>H', len(body)) + body).hexdigest()
+        key_id = digest[-16:]
+    elif version == 6:
+        if len(body) < 10:
+            raise InvalidKey('Truncated public key packet')
+        material = body[10:]
+        digest = hashlib.sha256(
+            b'\x9b' + struct.pack('>I', len(body)) + body).hexdigest()
+        key_id = digest[:16]
+    else:
+        raise InvalidKey(f'Unsupported key version {version}')
+    return (digest.upper(), key_id.upper(),
+            algorithm_name(body[5], material), created)
+
+
+def read_subpackets(data):
+    """
+    Yield the `(type, body)` subpackets of a signature area.
+    """
+    offset = 0
+    while offset < len(data):
+        first = data[offset]
+        if first < 192:
+            length, size = first, 1
+        elif first < 255:
+            if offset + 1 >= len(data):
+                raise InvalidKey('Truncated signature subpacket')
+            length = ((first - 192) << 8) + data[offset + 1] + 192
+            size = 2
+        else:
+            if offset + 5 > len(data):
+                raise InvalidKey('Truncated signature subpacket')
+            length, = struct.unpack_from('>I', data, offset + 1)
+            size = 5
+        offset += size
+        if length < 1 or offset + length > len(data):
+            raise InvalidKey('Truncated signature subpacket')
+        yield data[offset] & 0x7F, data[offset + 1:offset + length]
+        offset += length
+
+
+def parse_certification(body, fingerprint, key_id):
+    """
+    Return the creation time and key expiration time (in seconds after the
+    key creation) of a self-signature of the key with the given fingerprint
+    and key id, or None if it isn't one.
+    """
+    if len(body) < 4 or body[0] not in (4, 6):
+        return None
+    if body[1] not in CERTIFICATION_TYPES:
+        return None
+    # Subpacket area lengths take 2 bytes in v4 signatures, 4 in v6 ones
+    length_format = '>H' if body[0] == 4 else '>I'
+    size = struct.calcsize(length_format)
+    offset = 4
+    areas = []
+    for _ in range(2):
+        if len(body) < offset + size:
+            raise InvalidKey('Truncated signature')
+        length, = struct.unpack_from(length_format, body, offset)
+        offset += size
+        area = body[offset:offset + length]
+        if len(area) != length:
+            raise InvalidKey('Truncated signature')
+        areas.append(area)
+        offset += length
+    hashed, unhashed = areas
+
+    created = expiration = None
+    self_signed = False
+    for kind, value in read_subpackets(hashed):
+        if kind == CREATION_TIME_SUBPACKET and len(value) == 4:
+            created, = struct.unpack('>I', value)
+        elif kind == KEY_EXPIRATION_SUBPACKET and len(value) == 4:
+            expiration, = struct.unpack('>I', value)
+        else:
+            self_signed |= is_issuer(kind, value, fingerprint, key_id)
+    # The issuer usually is in the unhashed area
+    for kind, value in read_subpackets(unhashed):
+        self_signed |= is_issuer(kind, value, fingerprint, key_id)
+    if not self_signed:
+        return None
+    return created or 0, expiration
+
+
+def is_issuer(kind, value, fingerprint, key_id):
+    """
+    Whether an issuer subpacket names the given key.
+    """
+    if kind == ISSUER_SUBPACKET:
+        return value.hex().upper() == key_id
+    if kind == ISSUER_FINGERPRINT_SUBPACKET:
+        # Key version, then the fingerprint
+        return value[1:].hex().upper() == fingerprint
+    return False
+
+
+def parse_public_key(armored):
+    """
+    Parse an armored OpenPGP public key. The key expires as stated by its
+    latest self-signature, certifications by other keys being ignored.
+
+    Raises InvalidKey if it's malformed.
+    """
+    packets = iter(read_packets(dearmor(armored)))
+    tag, body = next(packets, (None, None))
+    if tag != PUBLIC_KEY_TAG:
+        raise InvalidKey('Expected a public key packet')
+    fingerprint, key_id, algorithm, created = parse_key_packet(body)
+
+    has_user_id = False
+    latest = None
+    for tag, body in packets:
+        if tag == PUBLIC_SUBKEY_TAG:
+            # Signatures of the subkeys follow
+            break
+        if tag == USER_ID_TAG:
+            has_user_id = True
+        elif tag == SIGNATURE_TAG:
+            certification = parse_certification(body, fingerprint, key_id)
+            if certification and (latest is None or
+                                  certification[0] >= latest[0]):
+                latest = certification
+    if not has_user_id:
+        raise InvalidKey('The key has no user id')
+
+    expires_at = None
+    if latest is not None and latest[1]:
+        expires_at = (datetime.fromtimestamp(created, timezone.utc) +
+                      timedelta(seconds=latest[1]))
+    return PublicKey(fingerprint, key_id, algorithm, expires_at)
+
+
+def fallback_fingerprint(armored):
+    """
+    Fingerprint of a key which can't be parsed: the hash of its armored
+    text, as before keys were parsed, so that it stays in the directory.
+    """
+    lines = armored.strip().splitlines()
+    armored = '\n'.join(line.rstrip() for line in lines)
+    return hashlib.sha256(armored.encode('utf-8')).hexdigest().upper()
+
+
+
+def index_keys(apps, schema_editor):
+    # Fingerprints were hashes of the armored keys until now. Keys which
+    # can't be parsed keep such a fingerprint, so they stay in the directory.
+    User = apps.get_model('core', 'User')
+    users = list(User.objects.only('id', 'pgp_public'))
+    for user in users:
+        try:
+            key = parse_public_key(user.pgp_public)
+        except InvalidKey:
+            key = None
+        user.pgp_fingerprint = (key.fingerprint if key else
+                                fallback_fingerprint(user.pgp_public))
+        user.pgp_key_id = key.key_id if key else ''
+        user.pgp_algorithm = key.algorithm if key else ''
+        user.pgp_expires_at = key.expires_at if key else None
+    User.objects.bulk_update(
+        users,
+        ['pgp_fingerprint', 'pgp_key_id', 'pgp_algorithm', 'pgp_expires_at'],
+        batch_size=500
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0003_user_pgp_fingerprint'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='user',
+            name='pgp_algorithm',
+            field=models.CharField(default='', editable=False, max_length=32),
+        ),
+        migrations.AddField(
+            model_name='user',
+            name='pgp_expires_at',
+            field=models.DateTimeField(blank=True, db_index=True, editable=False, null=True),
+        ),
+        migrations.AddField(
+            model_name='user',
+            name='pgp_key_id',
+            field=models.CharField(db_index=True, default='', editable=False, max_length=16),
+        ),
+        migrations.AlterField(
+            model_name='user',
+            name='pgp_public',
+            field=models.TextField(validators=[core.keys.validate_public_key]),
+        ),
+        migrations.RunPython(index_keys, migrations.RunPython.noop),
+    ]
@@ -1,11 +1,23 @@
 from django.contrib.auth.base_user import BaseUserManager
-from django.db import models
+from django.db import models, transaction
 from django.contrib.auth.models import AbstractBaseUser
 from django.contrib.auth.models import PermissionsMixin
 from django.utils import timezone
 from django.utils.translation import gettext_lazy as _
 from django.contrib.auth.validators import UnicodeUsernameValidator
 
+from core.hashing import check_password, hash_password
+from core.keys import (
+    InvalidKey,
+    fallback_fingerprint,
+    forget_public_key,
+    parse_public_key,
+    validate_public_key
+)
+
+# Columns derived from User.pgp_public
+KEY_FIELDS = ('pgp_fingerprint', 'pgp_key_id', 'pgp_algorithm', 'pgp_expires_at')
+
 
 class MyUserManager(BaseUserManager):
     use_in_migrations = True
@@ -40,7 +52,18 @@ class MyUserManager(BaseUserManager):
 
 
 class User(AbstractBaseUser, PermissionsMixin):
-    pgp_public = models.TextField(null=False, blank=False)
+    pgp_public = models.TextField(
+        null=False, blank=False, validators=[validate_public_key])
+    # Parsed from pgp_public when it changes. Conversation payloads refer to
+    # keys by fingerprint.
+    pgp_fingerprint = models.CharField(
+        max_length=64, db_index=True, editable=False, default='')
+    pgp_key_id = models.CharField(
+        max_length=16, db_index=True, editable=False, default='')
+    pgp_algorithm = models.CharField(
+        max_length=32, editable=False, default='')
+    pgp_expires_at = models.DateTimeField(
+        null=True, blank=True, db_index=True, editable=False)
     two_factor_auth = models.BooleanField(default=False)
     pgp_private = models.TextField(null=True, blank=True)
 
@@ -75,8 +98,69 @@ class User(AbstractBaseUser, PermissionsMixin):
 
     objects = MyUserManager()
 
+    # pgp_public as loaded from the database
+    _loaded_pgp_public = None
+
     USERNAME_FIELD = 'username'
     REQUIRED_FIELDS = []
 
     def __str__(self):
         return self.username
+
+    def set_password(self, raw_password):
+        self.password = hash_password(raw_password)
+        self._password = raw_password
+
+    def check_password(self, raw_password):
+        """
+        Hash outdated by the PASSWORD_HASHERS settings are transparently
+        replaced on login.
+        """
+        def setter(raw_password):
+            self.set_password(raw_password)
+            self._password = None
+            self.save(update_fields=['password'])
+        return check_password(raw_password, self.password, setter)
+
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        user = super().from_db(db, field_names, values)
+        # Keeps the key from being parsed again on every save
+        user._loaded_pgp_public = user.__dict__.get('pgp_public')
+        return user
+
+    def update_key_fields(self):
+        """
+        Index the fingerprint, key id, algorithm and expiry of pgp_public.
+        Keys which can't be parsed (validation rejects new ones) only get a
+        fallback fingerprint, to be found in the key directory.
+        """
+        try:
+            key = parse_public_key(self.pgp_public)
+        except InvalidKey:
+            key = None
+        self.pgp_fingerprint = (key.fingerprint if key else
+                                fallback_fingerprint(self.pgp_public))
+        self.pgp_key_id = key.key_id if key else ''
+        self.pgp_algorithm = key.algorithm if key else ''
+        self.pgp_expires_at = key.expires_at if key else None
+
+    def save(self, *args, **kwargs):
+        key_changed = ('pgp_public' not in self.get_deferred_fields() and
+                       self.pgp_public != self._loaded_pgp_public)
+        if key_changed:
+            previous = self.pgp_fingerprint
+            self.update_key_fields()
+            update_fields = kwargs.get('update_fields')
+            if update_fields is not None and 'pgp_public' in update_fields:
+                kwargs['update_fields'] = {*update_fields, *KEY_FIELDS}
+
+        super().save(*args, **kwargs)
+
+        if key_changed:
+            self._loaded_pgp_public = self.pgp_public
+            # The key directory caches keys by fingerprint
+            for fingerprint in {previous, self.pgp_fingerprint} - {''}:
+                transaction.on_commit(
+                    lambda fingerprint=fingerprint:
+                        forget_public_key(fingerprint))
@@ -1,12 +1,12 @@
-from django.contrib.auth.hashers import make_password
 from rest_framework import serializers
+from core.hashing import hash_password
 from core.models import User
 
 
 class PasswordField(serializers.CharField):
     def to_internal_value(self, data):
         # Hash the password before saving the user model
-        data = make_password(data)
+        data = hash_password(data)
         return data
 
 
@@ -24,6 +24,10 @@ class UserSerializer(serializers.ModelSerializer):
             'username',
             'password',
             'pgp_public',
+            'pgp_fingerprint',
+            'pgp_key_id',
+            'pgp_algorithm',
+            'pgp_expires_at',
             'pgp_private',
             'two_factor_auth',
         )
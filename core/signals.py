@@ -0,0 +1,29 @@
+from django.db import transaction
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+
+from core.authentication import bump_shared_generation, token_cache
+from core.models import User
+
+# Changes which must end the cached sessions of a user
+AUTH_FIELDS = {'password', 'is_active'}
+
+
+def forget_user(user_id):
+    # Other processes see the shared generation move
+    bump_shared_generation(user_id)
+    token_cache.forget_user(user_id)
+
+
+@receiver(post_save, sender=User)
+def forget_saved_user(sender, instance, update_fields=None, **kwargs):
+    if update_fields is not None and not AUTH_FIELDS & set(update_fields):
+        return
+    user_id = instance.pk
+    transaction.on_commit(lambda: forget_user(user_id))
+
+
+@receiver(post_delete, sender=User)
+def forget_deleted_user(sender, instance, **kwargs):
+    user_id = instance.pk
+    transaction.on_commit(lambda: forget_user(user_id))
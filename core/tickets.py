@@ -0,0 +1,65 @@
+from datetime import timedelta
+from uuid import uuid4
+from django.conf import settings
+from django.core.cache import cache, caches
+from rest_framework_simplejwt.tokens import Token
+
+try:
+    from django_redis.cache import RedisCache
+except ImportError:
+    RedisCache = None
+
+
+def issue_ticket(user_id):
+    """
+    Create a single-use websocket ticket for the given user.
+    """
+    ticket_uuid = str(uuid4())
+    cache.set(ticket_uuid, user_id, settings.TICKET_EXPIRE_TIME)
+    return ticket_uuid
+
+
+def consume_ticket(ticket_uuid):
+    """
+    Destroy a ticket and return the id of its user, or None if it doesn't
+    exist (anymore). A ticket can only be consumed once.
+    """
+    if not ticket_uuid:
+        return None
+
+    # `cache` is a proxy, the backend itself tells which one it is
+    backend = caches['default']
+    if RedisCache is not None and isinstance(backend, RedisCache):
+        # GET and DEL in a MULTI/EXEC transaction: atomic, one round trip
+        client = backend.client.get_client(write=True)
+        key = backend.client.make_key(ticket_uuid)
+        value, deleted = client.pipeline().get(key).delete(key).execute()
+        if value is None or not deleted:
+            return None
+        return backend.client.decode(value)
+
+    # Other backends: only the caller which deleted the ticket may use it
+    user_id = cache.get(ticket_uuid)
+    if user_id is None or not cache.delete(ticket_uuid):
+        return None
+    return user_id
+
+
+class WebsocketToken(Token):
+    """
+    Signed token only accepted by websocket connections, and only for
+    TICKET_EXPIRE_TIME seconds: unlike access tokens, it may end up in the
+    logs of the URLs it is passed in.
+    """
+    token_type = 'websocket'
+
+    @property
+    def lifetime(self):
+        return timedelta(seconds=settings.TICKET_EXPIRE_TIME)
+
+
+def issue_token(user):
+    """
+    Create a websocket token for the given user.
+    """
+    return str(WebsocketToken.for_user(user))
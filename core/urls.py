@@ -1,7 +1,13 @@
 from django.contrib.auth.decorators import login_required
 from django.urls import path
 from rest_framework_simplejwt import views as jwt_views
-from core.views import RegisterFilterAPIView, UserViewSet, schema_view
+from core.views import (
+    PublicKeyAPIView,
+    PublicKeyLookupAPIView,
+    RegisterFilterAPIView,
+    UserViewSet,
+    schema_view
+)
 
 urlpatterns = [
     path('user/', UserViewSet.as_view(
@@ -21,4 +27,6 @@ urlpatterns = [
     path('swagger/', login_required(schema_view.with_ui('swagger',
          cache_timeout=0)), name='swagger'),
     path('new_ws_ticket/', RegisterFilterAPIView.as_view()),
+    path('keys/', PublicKeyLookupAPIView.as_view()),
+    path('keys/<str:fingerprint>/', PublicKeyAPIView.as_view()),
 ]
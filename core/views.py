@@ -1,8 +1,8 @@
-from uuid import uuid4
-from django.core.cache import cache
+from django.utils.http import parse_etags
 from drf_yasg.views import get_schema_view
 from drf_yasg import openapi
-from rest_framework import permissions, authentication
+from rest_framework import permissions, authentication, status
+from rest_framework.exceptions import NotFound, ValidationError
 from rest_framework.response import Response
 from rest_framework.views import APIView
 from rest_framework.viewsets import GenericViewSet
@@ -12,10 +12,11 @@ from rest_framework.mixins import (
     UpdateModelMixin
 )
 
-from pgp_messenger_back.settings import TICKET_EXPIRE_TIME
+from core.keys import get_public_key
 from core.permissions import IsCreationOrIsAuthenticated
 from core.models import User
 from core.serializers import UserSerializer
+from core.tickets import issue_ticket, issue_token
 
 
 schema_view = get_schema_view(
@@ -55,12 +56,82 @@ class UserViewSet(CreateModelMixin,
 class RegisterFilterAPIView(APIView):
     """
         get:
-            API view for retrieving ticket uuid.
+            API view for retrieving ticket uuid, and a short-lived
+            websocket token.
     """
 
     def get(self, request, *args, **kwargs):
-        ticket_uuid = str(uuid4())
         # Assign the new ticket to the current user
-        cache.set(ticket_uuid, request.user.id, TICKET_EXPIRE_TIME)
+        ticket_uuid = issue_ticket(request.user.id)
 
-        return Response({'ticket_uuid': ticket_uuid})
+        return Response({
+            'ticket_uuid': ticket_uuid,
+            # Stateless alternative to the ticket, passed as `token`
+            'token': issue_token(request.user),
+        })
+
+
+def key_representation(key):
+    expires_at = key['pgp_expires_at']
+    return {
+        'fingerprint': key['pgp_fingerprint'],
+        'key_id': key['pgp_key_id'],
+        'algorithm': key['pgp_algorithm'],
+        'expires_at': expires_at.timestamp() if expires_at else None,
+    }
+
+
+class PublicKeyAPIView(APIView):
+    """
+        get:
+            API view for retrieving the public key with a fingerprint,
+            as referenced by conversation payloads. Clients revalidate the
+            keys they hold with `If-None-Match` and get a 304 Not Modified
+            unless the key changed (e.g. its expiry was extended).
+    """
+
+    def get(self, request, fingerprint, *args, **kwargs):
+        key = get_public_key(fingerprint.upper())
+        if key is None:
+            raise NotFound()
+
+        etag = f'"{key["etag"]}"'
+        headers = {'ETag': etag, 'Cache-Control': 'private, no-cache'}
+        # Weak comparison, as for any If-None-Match
+        tags = [tag[2:] if tag.startswith('W/') else tag for tag in
+                parse_etags(request.headers.get('If-None-Match', ''))]
+        if etag in tags or '*' in tags:
+            return Response(status=status.HTTP_304_NOT_MODIFIED,
+                            headers=headers)
+
+        return Response({
+            **key_representation(key),
+            'pgp_public': key['pgp_public'],
+        }, headers=headers)
+
+
+class PublicKeyLookupAPIView(APIView):
+    """
+        get:
+            API view for discovering the users of a key, by `fingerprint`
+            or by 16 hex digits `key_id`.
+    """
+
+    def get(self, request, *args, **kwargs):
+        if 'fingerprint' in request.query_params:
+            lookup = {'pgp_fingerprint':
+                      request.query_params['fingerprint'].upper()}
+        elif 'key_id' in request.query_params:
+            lookup = {'pgp_key_id': request.query_params['key_id'].upper()}
+        else:
+            raise ValidationError('A fingerprint or a key_id is required')
+
+        users = (User.objects
+                     .filter(is_active=True, **lookup)
+                     .exclude(pgp_fingerprint='')
+                     .values('username', 'pgp_fingerprint', 'pgp_key_id',
+                             'pgp_algorithm', 'pgp_expires_at'))
+        return Response([
+            {'username': user['username'], **key_representation(user)}
+            for user in users
+        ])
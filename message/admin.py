@@ -1,7 +1,7 @@
 from django.contrib import admin
 from django.urls import reverse
 from django.utils.html import format_html
-from message.models import Conversation, Message
+from message.models import Attachment, Conversation, Message
 
 
 @admin.register(Conversation)
@@ -27,3 +27,15 @@ class MessageAdmin(admin.ModelAdmin):
         return format_html(f'<a href="{link}">{obj.conversation}</a>')
     get_conversation.admin_order_field = 'conversation'
     get_conversation.short_description = 'Conversation'
+
+
+@admin.register(Attachment)
+class AttachmentAdmin(admin.ModelAdmin):
+    list_display = (
+        'id',
+        'conversation',
+        'user',
+        'size',
+        'received',
+        'created_at'
+    )
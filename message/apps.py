@@ -3,3 +3,6 @@ from django.apps import AppConfig
 
 class MessageConfig(AppConfig):
     name = 'message'
+
+    def ready(self):
+        import message.signals  # noqa: F401
@@ -0,0 +1,177 @@
+import asyncio
+import weakref
+
+from channels.db import database_sync_to_async
+from channels.layers import get_channel_layer
+from django.conf import settings
+from rest_framework.exceptions import ValidationError
+
+from message.encoding import encode_open
+from message.groups import conversation_group_name
+from message.models import Conversation
+from message.serializers import MessageSerializer, create_messages
+
+# Pending batches of the worker, per event loop and conversation
+_batchers = weakref.WeakKeyDictionary()
+
+
+def with_recipient_keys(data, message):
+    """
+    Add the key packets of every recipient to a message representation, so
+    each consumer of the conversation group can pick its own.
+    """
+    return {
+        **data,
+        'keys': {str(user_id): packet
+                 for user_id, packet in message.recipient_keys.items()},
+    }
+
+
+def message_event(data):
+    """
+    Group event of a message representation with recipient keys.
+
+    The frame is encoded once by the sender, and forwarded as is by the
+    consumers of the group, which only append the session key packet of
+    their reader.
+    """
+    frame = {key: value for key, value in data.items()
+             if key not in ('keys', 'key_packet')}
+    return {
+        'type': 'chat_message',
+        'conversation': data['conversation'],
+        'sequence': data['sequence'],
+        'keys': data['keys'],
+        'frame': encode_open({'type': 'chat_message', **frame}),
+    }
+
+
+def store_messages(conversation_id, items):
+    """
+    Validate and insert `(user, data)` items of one conversation, `data`
+    holding the message and its optional recipient keys.
+
+    Returns, in the same order, the representation of each stored message
+    or the ValidationError of each rejected one.
+    """
+    # Shared by the serializers so conversation members are loaded once
+    context = {
+        'websocket': True,
+        'binary': True,
+        'conversation': Conversation(pk=conversation_id),
+        'user': None,
+    }
+    results = []
+    valid = []
+    for user, message in items:
+        serializer = MessageSerializer(data=message, context=context)
+        if serializer.is_valid():
+            valid.append((user, serializer.validated_data))
+            results.append(None)
+        else:
+            results.append(ValidationError(serializer.errors))
+
+    messages = create_messages(conversation_id, valid)
+    data = MessageSerializer(messages, many=True, context=context).data
+    stored = iter(zip(data, messages))
+    return [
+        result if isinstance(result, ValidationError)
+        else with_recipient_keys(*next(stored))
+        for result in results
+    ]
+
+
+class ConversationBatcher:
+    """
+    Coalesces the messages sent to one conversation by the consumers of
+    this worker within WS_BATCH_WINDOW seconds.
+
+    Each batch is stored with one bulk insert and fanned out as a single
+    `chat_messages` group event. Batches of a conversation are flushed one
+    after the other, so sequence numbers and events stay in arrival order.
+    """
+
+    def __init__(self, conversation_id, registry):
+        self.conversation_id = conversation_id
+        self.registry = registry
+        self.pending = []
+        self.lock = asyncio.Lock()
+        self.flushes = 0
+        self.timer = None
+
+    def submit(self, user, message):
+        loop = asyncio.get_event_loop()
+        future = loop.create_future()
+        self.pending.append((user, message, future))
+
+        if len(self.pending) >= settings.WS_BATCH_SIZE:
+            if self.timer is not None:
+                self.timer.cancel()
+            self.schedule_flush(loop, 0)
+        elif self.timer is None:
+            self.schedule_flush(loop, settings.WS_BATCH_WINDOW)
+        return future
+
+    def schedule_flush(self, loop, delay):
+        self.timer = loop.call_later(
+            delay, lambda: asyncio.ensure_future(self.flush()))
+
+    async def flush(self):
+        self.timer = None
+        batch, self.pending = self.pending, []
+        if not batch:
+            return
+
+        self.flushes += 1
+        try:
+            async with self.lock:
+                await self.process(batch)
+        finally:
+            self.flushes -= 1
+            if not self.pending and not self.flushes and self.timer is None:
+                self.registry.pop(self.conversation_id, None)
+
+    async def process(self, batch):
+        try:
+            results = await database_sync_to_async(store_messages)(
+                self.conversation_id,
+                [(user, message) for user, message, _ in batch]
+            )
+            messages = [result for result in results
+                        if not isinstance(result, ValidationError)]
+            if messages:
+                await get_channel_layer().group_send(
+                    conversation_group_name(self.conversation_id),
+                    {
+                        'type': 'chat_messages',
+                        'messages': [message_event(message)
+                                     for message in messages],
+                    }
+                )
+        except Exception as e:
+            for _, _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+
+        for (_, _, future), result in zip(batch, results):
+            if future.done():
+                continue
+            if isinstance(result, ValidationError):
+                future.set_exception(result)
+            else:
+                future.set_result(result)
+
+
+def submit_message(conversation_id, user, message):
+    """
+    Queue a message for the next batch of its conversation. The returned
+    future resolves to its representation once it is stored.
+    """
+    loop = asyncio.get_event_loop()
+    registry = _batchers.setdefault(loop, {})
+    batcher = registry.get(conversation_id)
+    if batcher is None:
+        batcher = registry[conversation_id] = ConversationBatcher(
+            conversation_id, registry)
+    return batcher.submit(user, message)
@@ -1,43 +1,510 @@
+import asyncio
 import json
+import logging
+import time
 from urllib.parse import parse_qsl
 from asgiref.sync import sync_to_async
+from channels.db import database_sync_to_async
 from channels.generic.websocket import AsyncJsonWebsocketConsumer
-from django.core.cache import cache
+from django.conf import settings
+from rest_framework.exceptions import AuthenticationFailed, ValidationError
+from rest_framework_simplejwt.exceptions import InvalidToken
 
+from core.authentication import WebsocketTokenAuthentication
 from core.models import User
+from core.tickets import consume_ticket
+from message.batching import (
+    message_event,
+    submit_message,
+    with_recipient_keys
+)
+from message.cursors import move_cursor
+from message.encoding import (
+    close_json,
+    close_msgpack,
+    dumps_json,
+    dumps_msgpack,
+    loads_msgpack
+)
+from message.groups import conversation_group_name, user_group_name
+from message.membership import is_member
 from message.models import Conversation, Message
+from message.outbound import OutboundQueue
+from message.presence import mark_online
 from message.serializers import MessageSerializer
 
+logger = logging.getLogger(__name__)
 
-class ChatConsumer(AsyncJsonWebsocketConsumer):
-    async def authorize(self, ticket_uuid, conversation_id):
+
+@database_sync_to_async
+def get_ticket_user(ticket_uuid, conversation_id=None):
+    """
+    Consume a websocket ticket and return its active user. If
+    `conversation_id` is given, the user must also be a member of that
+    conversation.
+    """
+    user_id = consume_ticket(ticket_uuid)
+    if user_id is None:
+        return None
+
+    user = User.objects.filter(id=user_id, is_active=True).first()
+    if (user is None or conversation_id is not None and
+            not is_member(user.id, conversation_id)):
+        return None
+    return user
+
+
+@database_sync_to_async
+def get_token_user(raw_token, conversation_id=None):
+    """
+    Return the active user of a websocket token, without any query if the
+    token was verified recently. If `conversation_id` is given, the user
+    must also be a member of that conversation.
+    """
+    try:
+        user, _ = WebsocketTokenAuthentication().authenticate_token(raw_token)
+    except (InvalidToken, AuthenticationFailed):
+        return None
+
+    if (conversation_id is not None and
+            not is_member(user.id, conversation_id)):
+        return None
+    return user
+
+
+def merge_cursors(pending, event):
+    """
+    Coalesce two cursor events of a conversation, cursors only moving
+    forward.
+    """
+    cursors = {cursor['user']: cursor for cursor in pending['cursors']}
+    cursors.update((cursor['user'], cursor) for cursor in event['cursors'])
+    return {**event, 'cursors': list(cursors.values())}
+
+
+def parse_since(value):
+    """
+    Parse the `since` of a multiplexed connection: comma separated
+    `<conversation>:<sequence>` pairs, as in the resume hint of an overflow.
+    """
+    since = {}
+    for pair in filter(None, value.split(',')):
+        conversation_id, sequence = pair.split(':')
+        since[int(conversation_id)] = int(sequence)
+    return since
+
+
+class MessageConsumerMixin:
+    binary_frames = False
+    # Conversations whose groups the connection follows
+    conversation_ids = ()
+    # When this connection last sent a presence heartbeat, and its typing
+    # state per conversation with when it was sent
+    presence_sent_at = None
+    typing_sent = None
+    # Frames waiting to be written to the client, once connected
+    outbound = None
+    # Messages of the client waiting for their batch
+    acknowledgements = None
+    # Sequence number of the last message streamed by the replay of each
+    # conversation. Live events may arrive out of order, so only these marks
+    # are deduplicated against, they don't move with them.
+    replayed_sequences = None
+
+    async def get_user(self, query_params, conversation_id=None):
+        """
+        Authenticate the connection with a short-lived websocket token
+        (`token`) or a single-use ticket (`ticket_uuid`), both issued by
+        new_ws_ticket/. Access tokens are refused: URLs end up in logs.
+        """
+        if query_params.get('token'):
+            return await get_token_user(
+                query_params['token'], conversation_id)
+        # The ticket is destroyed for performance and security purposes
+        return await get_ticket_user(
+            query_params.get('ticket_uuid'), conversation_id)
+
+    def create_message(self, data, user, conversation):
+        serializer = MessageSerializer(data=data)
+        serializer.context['websocket'] = True
+        serializer.context['binary'] = True
+        serializer.context['user'] = user
+        serializer.context['conversation'] = conversation
+
+        serializer.is_valid(raise_exception=True)
+        serializer.save()
+
+        return with_recipient_keys(serializer.data, serializer.instance)
+
+    async def new_message(self, data, user, conversation):
+        # Validation, insert and representation may all touch the database:
+        # run them in a single worker thread call, off the event loop
+        return await database_sync_to_async(self.create_message)(
+            data, user, conversation)
+
+    async def publish_message(self, data, conversation):
+        data = await self.new_message(
+            data,
+            self.scope['user'],
+            conversation
+        )
+
+        # The message carries its gap-free sequence number, so clients
+        # can check whether they're synced without any extra query
+        await self.channel_layer.group_send(
+            conversation_group_name(conversation.pk),
+            message_event(data)
+        )
+        return data
+
+    async def receive_frame(self, frame, conversation):
+        """
+        Handle a client frame: a `read` or `delivered` cursor move with the
+        `sequence` of the last message read or delivered, a `typing` or
+        `presence` indicator, or a message (`message` type, or none).
+        Other types are answered with an `error` frame.
+        """
+        frame_type = frame.get('type')
+        if frame_type == 'typing':
+            await self.send_typing(frame, conversation)
+        elif frame_type == 'presence':
+            await self.heartbeat()
+        elif frame_type in ('read', 'delivered'):
+            await self.move_cursor(frame, conversation)
+        elif frame_type in (None, 'message'):
+            await self.send_message(frame, conversation)
+        else:
+            await self.send_frame({
+                'type': 'error',
+                'conversation': conversation.pk,
+                'nonce': frame.get('nonce'),
+                'detail': 'Unknown frame type',
+            })
+
+    def get_conversation_ids(self):
+        return self.conversation_ids
+
+    async def heartbeat(self):
+        """
+        Keep the user online in the presence cache, at most once per
+        PRESENCE_HEARTBEAT_INTERVAL per connection. Users coming online are
+        announced to their conversations.
+        """
+        now = time.monotonic()
+        interval = settings.PRESENCE_HEARTBEAT_INTERVAL
+        if (self.presence_sent_at is not None and
+                now - self.presence_sent_at < interval):
+            return
+        self.presence_sent_at = now
+
+        user = self.scope['user']
+        if not await sync_to_async(mark_online, thread_sensitive=False)(
+                user.id):
+            return
+        for conversation_id in self.get_conversation_ids():
+            await self.channel_layer.group_send(
+                conversation_group_name(conversation_id),
+                {
+                    'type': 'chat_presence',
+                    'user': user.username,
+                    'online': True,
+                }
+            )
+
+    async def send_typing(self, frame, conversation):
+        """
+        Fan out a typing indicator, never stored. Repeated `typing` frames
+        are only forwarded once per TYPING_EVENT_INTERVAL, and `typing:
+        false` only after a `typing: true`.
+        """
+        typing = bool(frame.get('typing', True))
+        now = time.monotonic()
+        if self.typing_sent is None:
+            self.typing_sent = {}
+        last_typing, sent_at = self.typing_sent.get(
+            conversation.pk, (False, None))
+        if typing == last_typing and (
+                not typing or now - sent_at < settings.TYPING_EVENT_INTERVAL):
+            return
+        self.typing_sent[conversation.pk] = (typing, now)
+
+        await self.channel_layer.group_send(
+            conversation_group_name(conversation.pk),
+            {
+                'type': 'chat_typing',
+                'conversation': conversation.pk,
+                'user': self.scope['user'].username,
+                'typing': typing,
+            }
+        )
+
+    async def move_cursor(self, frame, conversation):
+        sequence = frame.get('sequence')
+        if (not isinstance(sequence, int) or isinstance(sequence, bool) or
+                sequence < 0):
+            await self.send_frame({
+                'type': 'error',
+                'conversation': conversation.pk,
+                'detail': 'A sequence number is required',
+            })
+            return
+
+        move_cursor(conversation.pk, self.scope['user'],
+                    **{frame['type']: sequence})
+
+    async def send_message(self, frame, conversation):
+        """
+        Store the message of a client frame and fan it out to its
+        conversation group.
+
+        The sender gets an `ack` frame echoing the optional `nonce` of its
+        frame, or an `error` frame if the message was rejected. With
+        WS_BATCH_WINDOW set, the message joins the next batch of its
+        conversation and the consumer goes on reading frames meanwhile, so
+        one socket can fill a batch.
+        """
+        data = {key: frame[key]
+                for key in ('message', 'binary_message', 'keys', 'attachments')
+                if key in frame}
+        nonce = frame.get('nonce')
+        if settings.WS_BATCH_WINDOW is None:
+            await self.acknowledge(
+                self.publish_message(data, conversation),
+                conversation.pk,
+                nonce
+            )
+        else:
+            if self.acknowledgements is None:
+                self.acknowledgements = set()
+            task = asyncio.ensure_future(self.acknowledge(
+                submit_message(conversation.pk, self.scope['user'], data),
+                conversation.pk,
+                nonce
+            ))
+            self.acknowledgements.add(task)
+            task.add_done_callback(self.acknowledgements.discard)
+
+    async def acknowledge(self, pending, conversation_id, nonce):
         try:
-            self.conversation_id = conversation_id
+            data = await pending
+        except Exception as e:
+            if isinstance(e, ValidationError):
+                detail = e.detail
+            else:
+                logger.exception('Could not store a message of '
+                                 'conversation %s', conversation_id)
+                detail = 'The message could not be stored, try again'
+            await self.send_frame({
+                'type': 'error',
+                'conversation': conversation_id,
+                'nonce': nonce,
+                'detail': detail,
+            })
+            return
+
+        # Senders have read their own messages, the move joins the next
+        # batched cursor write
+        move_cursor(conversation_id, self.scope['user'],
+                    read=data['sequence'])
+        if nonce is not None:
+            await self.send_frame({
+                'type': 'ack',
+                'conversation': conversation_id,
+                'nonce': nonce,
+                'id': data['id'],
+                'sequence': data['sequence'],
+            })
+
+    def parse_frame(self, text_data, bytes_data):
+        if bytes_data is not None:
+            return loads_msgpack(bytes_data)
+        return json.loads(text_data)
+
+    def open_outbound(self):
+        self.outbound = OutboundQueue(
+            settings.WS_OUTBOUND_QUEUE_SIZE, self.write_frame, self.overflow)
+
+    def close_outbound(self):
+        if self.outbound is not None:
+            self.outbound.close()
+
+    async def send_frame(self, payload, key=None, ephemeral=False,
+                         merge=None):
+        """
+        Queue a frame for the client. See OutboundQueue for `key`,
+        `ephemeral` and `merge`.
+        """
+        if self.outbound is None:
+            await self.write_frame(payload)
+        else:
+            self.outbound.put(payload, key=key, ephemeral=ephemeral,
+                              merge=merge)
+
+    async def wait_for_room(self):
+        """
+        Wait until the client has room for another frame, so frames sent at
+        the server's pace don't overflow its queue. Return False once the
+        connection is closing.
+        """
+        if self.outbound is None:
+            return True
+        return await self.outbound.wait_for_room()
+
+    async def write_frame(self, payload):
+        """
+        Send a frame with the encoding negotiated by the client: JSON text
+        by default, MessagePack binary frames with `?encoding=msgpack`.
+        Frames already `encoded` by for_reader are sent as is.
+        """
+        encoded = payload.get('encoded')
+        if self.binary_frames:
+            await self.send(bytes_data=encoded or dumps_msgpack(payload))
+        else:
+            await self.send(text_data=encoded or dumps_json(payload))
+
+    async def overflow(self, sent_sequences):
+        """
+        Disconnect a client which doesn't keep up with its frames, telling
+        it the last message sent per conversation to resume from.
+        """
+        await self.write_frame({
+            'type': 'overflow',
+            'detail': 'Too many pending frames, reconnect to resume',
+            'resume': [
+                {'conversation': conversation_id, 'since': sequence}
+                for conversation_id, sequence in sent_sequences.items()
+            ],
+        })
+        # 1013: try again later
+        await self.close(code=1013)
+
+    def for_reader(self, event):
+        """
+        Complete the pre-encoded frame of a message event with the session
+        key packet of the connected user only.
+        """
+        key_packet = event['keys'].get(str(self.scope['user'].id))
+        if self.binary_frames:
+            encoded = close_msgpack(event['frame'], 'key_packet', key_packet)
+        else:
+            encoded = close_json(event['frame'], 'key_packet', key_packet)
+        return {
+            'type': 'chat_message',
+            'conversation': event['conversation'],
+            'sequence': event['sequence'],
+            'encoded': encoded,
+        }
+
+    def get_missed_messages(self, conversation_id, since):
+        user = self.scope['user']
+        messages = (Message.objects
+                           .for_reader(user)
+                           .filter(conversation=conversation_id,
+                                   sequence__gt=since)
+                           .order_by('sequence')[:settings.WS_SYNC_BATCH_SIZE])
+        return MessageSerializer(messages, many=True, context={
+            'websocket': True,
+            'binary': True,
+            'user': user,
+        }).data
+
+    async def replay(self, conversation_id):
+        """
+        Stream the messages of a conversation the client missed since its
+        mark in `replayed_sequences`.
+
+        The conversation group is joined beforehand, so messages sent during
+        the replay are queued and delivered once it is over. Pages are only
+        read once the client has room for them: a slow client slows the
+        replay down instead of overflowing.
+        """
+        while True:
+            if not await self.wait_for_room():
+                return
+            messages = await database_sync_to_async(self.get_missed_messages)(
+                conversation_id, self.replayed_sequences[conversation_id])
+            if messages:
+                self.replayed_sequences[conversation_id] = (
+                    messages[-1]['sequence'])
+                await self.send_frame({
+                    'type': 'sync',
+                    'messages': messages,
+                })
+            if len(messages) < settings.WS_SYNC_BATCH_SIZE:
+                break
+
+        if not await self.wait_for_room():
+            return
+        await self.send_frame({
+            'type': 'sync_complete',
+            'conversation': conversation_id,
+            'sequence': self.replayed_sequences[conversation_id],
+        })
 
-            self.scope['has_ticket'] = bool(cache.get(ticket_uuid))
-            self.scope['user'] = await sync_to_async(
-                User.objects.get
-            )(id=cache.get(ticket_uuid))
-            self.scope['conversation'] = await sync_to_async(
-                Conversation.objects.get
-            )(id=self.conversation_id, users=self.scope['user'])
+    # Receive a message from a conversation group
+    async def chat_message(self, event):
+        # Skip messages already streamed by the replay
+        replayed = (self.replayed_sequences or {}).get(event['conversation'])
+        if replayed is not None and event['sequence'] <= replayed:
+            return
+        await self.send_frame(self.for_reader(event))
+
+    # Receive a batch of messages from a conversation group
+    async def chat_messages(self, event):
+        for message in event['messages']:
+            await self.chat_message(message)
+
+    # Receive read and delivery cursor moves from a conversation group
+    async def chat_cursors(self, event):
+        await self.send_frame(
+            event,
+            key=('cursors', event['conversation']),
+            merge=merge_cursors
+        )
+
+    # Receive ephemeral events from a conversation group, except the ones
+    # of the connected user
+    async def chat_typing(self, event):
+        if event['user'] != self.scope['user'].username:
+            await self.send_frame(
+                event,
+                key=('typing', event['conversation'], event['user']),
+                ephemeral=True
+            )
+
+    async def chat_presence(self, event):
+        if event['user'] != self.scope['user'].username:
+            await self.send_frame(
+                event,
+                key=('presence', event['user']),
+                ephemeral=True
+            )
 
-            # Destroy ticket for performance and security purposes
-            if not cache.delete(ticket_uuid):
-                raise Exception('Ticket not found')
 
-        except (User.DoesNotExist, Conversation.DoesNotExist):
+class ChatConsumer(MessageConsumerMixin, AsyncJsonWebsocketConsumer):
+    async def authorize(self, query_params, conversation_id):
+        self.conversation_id = int(conversation_id)
+
+        user = await self.get_user(query_params, self.conversation_id)
+        if user is None:
             raise Exception('Unauthorized')
 
+        self.scope['user'] = user
+        self.scope['conversation'] = Conversation(pk=self.conversation_id)
+
     async def websocket_connect(self, event):
         try:
             query_string = self.scope['query_string'].decode('utf-8')
             query_params = dict(parse_qsl(query_string))
             # Check whether the websocket connection is authorized
             await self.authorize(
-                query_params.get('ticket_uuid'),
+                query_params,
                 self.scope['url_route']['kwargs']['room_name']
             )
+            if 'since' in query_params:
+                self.replayed_sequences = {
+                    self.conversation_id: int(query_params['since'])}
+            self.binary_frames = query_params.get('encoding') == 'msgpack'
 
         except Exception:
             await self.close()
@@ -46,7 +513,7 @@ class ChatConsumer(AsyncJsonWebsocketConsumer):
         await self.connect()
 
     async def connect(self):
-        self.room_group_name = 'chat_%s' % self.conversation_id
+        self.room_group_name = conversation_group_name(self.conversation_id)
 
         # Join room group
         await self.channel_layer.group_add(
@@ -55,56 +522,146 @@ class ChatConsumer(AsyncJsonWebsocketConsumer):
         )
 
         await self.accept()
+        self.open_outbound()
+        await self.heartbeat()
+
+        if self.replayed_sequences:
+            await self.replay(self.conversation_id)
+
+    def get_conversation_ids(self):
+        return [self.conversation_id]
 
     async def disconnect(self, close_code):
+        self.close_outbound()
         # Leave room group
         await self.channel_layer.group_discard(
             self.room_group_name,
             self.channel_name
         )
 
-    async def new_message(self, message, user, conversation):
-        serializer = MessageSerializer(data={
-            'message': message
-        })
-        serializer.context['websocket'] = True
-        serializer.context['user'] = user
-        serializer.context['conversation'] = conversation
+    # Receive message from WebSocket
+    async def receive(self, text_data=None, bytes_data=None):
+        frame = self.parse_frame(text_data, bytes_data)
+        await self.receive_frame(frame, self.scope['conversation'])
 
-        serializer.is_valid(raise_exception=True)
-        await sync_to_async(serializer.save)()
 
-        return serializer.data
+class UserConsumer(MessageConsumerMixin, AsyncJsonWebsocketConsumer):
+    """
+    Multiplexed websocket carrying every conversation of a user.
 
-    # Receive message from WebSocket
-    async def receive(self, text_data):
-        text_data_json = json.loads(text_data)
-        conversation = self.scope['conversation']
-        data = await self.new_message(
-            text_data_json['message'],
-            self.scope['user'],
-            conversation
+    Frames sent by the client and events sent to it hold the id of their
+    conversation. The consumer follows the conversation groups of the user,
+    and its per-user group tells it when they change. Clients reconnecting
+    pass `since=<conversation>:<sequence>,...` to replay what they missed.
+    """
+    user_group_name = None
+
+    async def authorize(self, query_params):
+        user = await self.get_user(query_params)
+        if user is None:
+            raise Exception('Unauthorized')
+
+        self.scope['user'] = user
+
+    async def websocket_connect(self, event):
+        try:
+            query_string = self.scope['query_string'].decode('utf-8')
+            query_params = dict(parse_qsl(query_string))
+            # Check whether the websocket connection is authorized
+            await self.authorize(query_params)
+            self.replayed_sequences = parse_since(
+                query_params.get('since', ''))
+            self.binary_frames = query_params.get('encoding') == 'msgpack'
+
+        except Exception:
+            await self.close()
+            return
+
+        await self.connect()
+
+    async def connect(self):
+        self.user_group_name = user_group_name(self.scope['user'].id)
+
+        # Join the user group before listing the conversations, so no
+        # membership change can be missed in between
+        await self.channel_layer.group_add(
+            self.user_group_name,
+            self.channel_name
         )
+        self.conversation_ids = set(await database_sync_to_async(
+            lambda: list(self.scope['user'].conversations
+                                           .values_list('id', flat=True))
+        )())
+        for conversation_id in self.conversation_ids:
+            await self.channel_layer.group_add(
+                conversation_group_name(conversation_id),
+                self.channel_name
+            )
 
-        # Send last message id so client can check whether it's synced
-        prev_id = None
-        last_msg = await sync_to_async(
-            lambda c: Message.objects.filter(conversation=c).last()
-        )(conversation)
-        if last_msg:
-            prev_id = last_msg.id
+        await self.accept()
+        self.open_outbound()
+        await self.heartbeat()
 
-        # Send message to room group
-        await self.channel_layer.group_send(
-            self.room_group_name,
-            {
-                'type': 'chat_message',
-                'prev_id': prev_id,
-                **data
-            }
+        # Only the conversations of the user are replayed
+        self.replayed_sequences = {
+            conversation_id: sequence
+            for conversation_id, sequence in self.replayed_sequences.items()
+            if conversation_id in self.conversation_ids
+        }
+        for conversation_id in self.replayed_sequences:
+            await self.replay(conversation_id)
+
+    async def disconnect(self, close_code):
+        self.close_outbound()
+        if self.user_group_name is None:
+            return
+
+        await self.channel_layer.group_discard(
+            self.user_group_name,
+            self.channel_name
         )
+        for conversation_id in self.conversation_ids:
+            await self.channel_layer.group_discard(
+                conversation_group_name(conversation_id),
+                self.channel_name
+            )
 
-    # Receive message from room group
-    async def chat_message(self, event):
-        # Send message to WebSocket
-        await self.send(text_data=json.dumps(event))
+    # Receive message from WebSocket
+    async def receive(self, text_data=None, bytes_data=None):
+        frame = self.parse_frame(text_data, bytes_data)
+        if frame.get('type') == 'presence':
+            # Presence isn't tied to a conversation
+            await self.heartbeat()
+            return
+
+        conversation_id = frame.get('conversation')
+        if conversation_id not in self.conversation_ids:
+            await self.send_frame({
+                'type': 'error',
+                'conversation': conversation_id,
+                'detail': 'Unknown conversation',
+            })
+            return
+
+        await self.receive_frame(frame, Conversation(pk=conversation_id))
+
+    # Receive membership changes from the user group
+    async def conversation_joined(self, event):
+        conversation_id = event['conversation']
+        if conversation_id not in self.conversation_ids:
+            self.conversation_ids.add(conversation_id)
+            await self.channel_layer.group_add(
+                conversation_group_name(conversation_id),
+                self.channel_name
+            )
+        await self.send_frame(event)
+
+    async def conversation_left(self, event):
+        conversation_id = event['conversation']
+        if conversation_id in self.conversation_ids:
+            self.conversation_ids.discard(conversation_id)
+            await self.channel_layer.group_discard(
+                conversation_group_name(conversation_id),
+                self.channel_name
+            )
+        await self.send_frame(event)
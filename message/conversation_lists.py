@@ -0,0 +1,62 @@
+"""
+Conversation lists cached per user under a version, which is also their
+ETag. Changes drop the version of every member of the conversation, so the
+next list is rendered under a new one.
+"""
+from uuid import uuid4
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+
+from message.models import Conversation
+
+
+def version_key(user_id):
+    return f'conversation_list_version:{user_id}'
+
+
+def list_key(user_id, version):
+    return f'conversation_list:{user_id}:{version}'
+
+
+def get_version(user_id):
+    key = version_key(user_id)
+    version = cache.get(key)
+    if version is None:
+        version = uuid4().hex
+        if not cache.add(key, version, settings.CONVERSATION_LIST_CACHE_TTL):
+            # Set by a concurrent request
+            version = cache.get(key) or version
+    return version
+
+
+def get_list(user_id, version):
+    return cache.get(list_key(user_id, version))
+
+
+def set_list(user_id, version, data):
+    cache.set(list_key(user_id, version), data,
+              settings.CONVERSATION_LIST_CACHE_TTL)
+
+
+def invalidate_users(user_ids):
+    """
+    Drop the list versions of some users, now and once the current
+    transaction commits, so no list rendered before the commit is served.
+    """
+    keys = [version_key(user_id) for user_id in set(user_ids)]
+    if keys:
+        cache.delete_many(keys)
+        transaction.on_commit(lambda: cache.delete_many(keys))
+
+
+def invalidate_conversations(conversation_ids):
+    """
+    Drop the list versions of the members of some conversations.
+    """
+    invalidate_users(
+        Conversation.users.through.objects
+                    .filter(conversation_id__in=conversation_ids)
+                    .values_list('user_id', flat=True)
+    )
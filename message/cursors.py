@@ -0,0 +1,103 @@
+import asyncio
+import weakref
+
+from channels.db import database_sync_to_async
+from channels.layers import get_channel_layer
+from django.conf import settings
+from django.db import transaction
+
+from message.conversation_lists import invalidate_users
+from message.groups import conversation_group_name
+from message.models import Conversation, ReadCursor
+
+# Pending cursor moves of the worker, per event loop
+_buffers = weakref.WeakKeyDictionary()
+
+
+def store_cursors(moves):
+    """
+    Write `{(conversation_id, user_id): (username, read, delivered)}` cursor
+    moves in one transaction, clamped to the last sequence of their
+    conversation.
+
+    Returns the stored cursors, per conversation.
+    """
+    last_sequences = dict(
+        Conversation.objects
+                    .filter(pk__in={key[0] for key in moves})
+                    .values_list('pk', 'last_sequence'))
+    cursors = {}
+    with transaction.atomic():
+        for (conversation_id, user_id), move in moves.items():
+            username, read, delivered = move
+            last = last_sequences.get(conversation_id)
+            if last is None:
+                continue
+            read, delivered = min(read, last), min(delivered, last)
+            ReadCursor.objects.advance(
+                conversation_id, user_id, read=read, delivered=delivered)
+            cursors.setdefault(conversation_id, []).append({
+                'user': username,
+                'read_sequence': read,
+                'delivered_sequence': max(read, delivered),
+            })
+        # Unread counts of the conversation lists
+        invalidate_users(user_id for _, user_id in moves)
+    return cursors
+
+
+class CursorBuffer:
+    """
+    Coalesces the cursor moves received by the consumers of this worker, so
+    a member reading many messages costs one write per
+    READ_CURSOR_FLUSH_INTERVAL.
+
+    Each flush fans out one `chat_cursors` event per conversation.
+    """
+
+    def __init__(self):
+        self.pending = {}
+        self.timer = None
+
+    def move(self, conversation_id, user, read=0, delivered=0):
+        key = (conversation_id, user.id)
+        _, pending_read, pending_delivered = self.pending.get(
+            key, (None, 0, 0))
+        self.pending[key] = (
+            user.username,
+            max(read, pending_read),
+            max(delivered, pending_delivered),
+        )
+        if self.timer is None:
+            self.timer = asyncio.get_event_loop().call_later(
+                settings.READ_CURSOR_FLUSH_INTERVAL,
+                lambda: asyncio.ensure_future(self.flush()))
+
+    async def flush(self):
+        self.timer = None
+        moves, self.pending = self.pending, {}
+        if not moves:
+            return
+
+        cursors = await database_sync_to_async(store_cursors)(moves)
+        channel_layer = get_channel_layer()
+        for conversation_id, conversation_cursors in cursors.items():
+            await channel_layer.group_send(
+                conversation_group_name(conversation_id),
+                {
+                    'type': 'chat_cursors',
+                    'conversation': conversation_id,
+                    'cursors': conversation_cursors,
+                }
+            )
+
+
+def move_cursor(conversation_id, user, read=0, delivered=0):
+    """
+    Queue a cursor move for the next flush of this worker.
+    """
+    loop = asyncio.get_event_loop()
+    buffer = _buffers.get(loop)
+    if buffer is None:
+        buffer = _buffers[loop] = CursorBuffer()
+    buffer.move(conversation_id, user, read=read, delivered=delivered)
@@ -0,0 +1,108 @@
+"""
+Bookkeeping of message deletions: tombstones for delta sync, conversation
+summaries, and the cached conversation and message lists.
+
+Single messages are handled as they are deleted. Deletions of many
+messages at once (querysets, cascades from a user) collect their
+tombstones and write them in bulk when they are over, and messages deleted
+along with their conversation are skipped altogether.
+"""
+import threading
+from contextlib import contextmanager
+
+from django.db.models import F
+from django.utils import timezone
+
+from message import message_lists
+from message.conversation_lists import invalidate_conversations
+from message.models import Conversation, MessageTombstone
+
+
+class Deletions(threading.local):
+    def __init__(self):
+        # Conversations and users being deleted, with their messages
+        self.conversations = set()
+        self.users = set()
+        # Senders of the messages deleted along with their conversation
+        self.senders = set()
+        # Nesting of the bulk deletions in progress and their tombstones
+        self.depth = 0
+        self.tombstones = []
+
+    def reset(self):
+        self.__init__()
+
+
+deletions = Deletions()
+
+
+def message_deleted(message):
+    if message.conversation_id in deletions.conversations:
+        deletions.senders.add(message.user_id)
+        return
+
+    tombstone = MessageTombstone(
+        message_id=message.pk,
+        conversation_id=message.conversation_id,
+        user_id=message.user_id,
+        sequence=message.sequence,
+    )
+    if deletions.depth or message.user_id in deletions.users:
+        deletions.tombstones.append(tombstone)
+        return
+
+    # Runs inside the deletion transaction. If the message was the last one
+    # of its conversation, SET_NULL already cleared `last_message`.
+    conversations = Conversation.objects.filter(pk=message.conversation_id)
+    conversations.update(
+        message_count=F('message_count') - 1,
+        last_activity=timezone.now(),
+    )
+    conversations.refresh_last_message()
+    invalidate_conversations([message.conversation_id])
+    message_lists.invalidate_users([message.user_id])
+    tombstone.save()
+
+
+def flush_deletions():
+    """
+    Write the tombstones collected by bulk deletions and update the
+    summaries of their conversations.
+    """
+    tombstones, deletions.tombstones = deletions.tombstones, []
+    if not tombstones:
+        return
+    MessageTombstone.objects.bulk_create(tombstones)
+    conversation_ids = {tombstone.conversation_id for tombstone in tombstones}
+    Conversation.objects.filter(pk__in=conversation_ids).recount_messages()
+    invalidate_conversations(conversation_ids)
+    message_lists.invalidate_users(
+        tombstone.user_id for tombstone in tombstones)
+
+
+def flush_senders():
+    """
+    Drop the message lists of the senders of the messages deleted along with
+    their conversation, which leave no tombstone.
+    """
+    senders, deletions.senders = deletions.senders, set()
+    message_lists.invalidate_users(senders)
+
+
+@contextmanager
+def bulk_deletion():
+    """
+    Collect the tombstones of the messages deleted in the block, and write
+    them with the summary updates once it is over.
+    """
+    deletions.depth += 1
+    try:
+        yield
+    except BaseException:
+        deletions.depth -= 1
+        if not deletions.depth:
+            deletions.tombstones = []
+        raise
+    deletions.depth -= 1
+    if not deletions.depth:
+        flush_deletions()
@@ -0,0 +1,87 @@
+import base64
+import functools
+import json
+
+import msgpack
+from django.conf import settings
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+def _encode_bytes(obj):
+    # Binary fields travel raw through the channel layer and MessagePack,
+    # JSON clients get them as base64 text
+    if isinstance(obj, (bytes, bytearray, memoryview)):
+        return base64.b64encode(bytes(obj)).decode('ascii')
+    raise TypeError(f'{type(obj).__name__} is not JSON serializable')
+
+
+def dumps_json(data):
+    if orjson is not None:
+        return orjson.dumps(data, default=_encode_bytes).decode()
+    return json.dumps(data, default=_encode_bytes)
+
+
+def dumps_msgpack(data):
+    return msgpack.packb(data, use_bin_type=True)
+
+
+def loads_msgpack(data):
+    return msgpack.unpackb(data, raw=False)
+
+
+def _map_header_size(length):
+    if length < 16:
+        return 1
+    if length < 2 ** 16:
+        return 3
+    return 5
+
+
+def _map_header(length):
+    if length < 16:
+        return bytes([0x80 | length])
+    if length < 2 ** 16:
+        return b'\xde' + length.to_bytes(2, 'big')
+    return b'\xdf' + length.to_bytes(4, 'big')
+
+
+def encode_open(data):
+    """
+    Encode a non-empty map once, leaving it open so each reader only
+    encodes the field it adds with `close_msgpack` or `close_json`.
+
+    Only MessagePack goes through the channel layer. JSON readers get it
+    converted once per process.
+    """
+    packed = dumps_msgpack(data)
+    return {
+        'msgpack': packed[_map_header_size(len(data)):],
+        'length': len(data),
+    }
+
+
+# Consumers walk the messages of a batch event in order: the cache holds a
+# whole batch, and another one being fanned out meanwhile
+@functools.lru_cache(maxsize=2 * settings.WS_BATCH_SIZE)
+def _open_json(packed, length):
+    return dumps_json(loads_msgpack(_map_header(length) + packed))[:-1]
+
+
+def close_json(encoded, key, value):
+    # Consumers of a group get their own copy of the event, the cache is
+    # keyed by its content
+    body = _open_json(encoded['msgpack'], encoded['length'])
+    return f'{body},{dumps_json(key)}:{dumps_json(value)}}}'
+
+
+def close_msgpack(encoded, key, value):
+    return b''.join((
+        _map_header(encoded['length'] + 1),
+        encoded['msgpack'],
+        dumps_msgpack(key),
+        dumps_msgpack(value),
+    ))
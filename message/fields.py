@@ -1,4 +1,7 @@
+import base64
+import binascii
 from django.core.exceptions import ValidationError
+from rest_framework import serializers
 from rest_framework.serializers import PrimaryKeyRelatedField
 from core.models import User
 
@@ -19,5 +22,29 @@ class RelatedUserField(PrimaryKeyRelatedField):
     def to_representation(self, obj):
         return {
             'username': obj.username,
-            'pgp_public': obj.pgp_public
+            # The key itself is fetched once from the key directory
+            'pgp_fingerprint': obj.pgp_fingerprint
         }
+
+
+class BinaryField(serializers.Field):
+    """
+    Raw bytes for clients which negotiated a binary encoding (`binary` in
+    the serializer context), base64 text otherwise.
+    """
+
+    def to_internal_value(self, data):
+        if isinstance(data, (bytes, bytearray)):
+            return bytes(data)
+        if isinstance(data, str):
+            try:
+                return base64.b64decode(data, validate=True)
+            except binascii.Error:
+                raise serializers.ValidationError('Invalid base64 data')
+        raise serializers.ValidationError('Expected bytes or base64 text')
+
+    def to_representation(self, value):
+        value = bytes(value)
+        if self.context.get('binary'):
+            return value
+        return base64.b64encode(value).decode('ascii')
@@ -0,0 +1,20 @@
+from asgiref.sync import async_to_sync
+from channels.layers import get_channel_layer
+
+
+def conversation_group_name(conversation_id):
+    return 'chat_%s' % conversation_id
+
+
+def user_group_name(user_id):
+    return 'user_%s' % user_id
+
+
+def notify_users(user_ids, event):
+    """
+    Send an event to the multiplexed websockets of the given users.
+    """
+    channel_layer = get_channel_layer()
+    for user_id in user_ids:
+        async_to_sync(channel_layer.group_send)(
+            user_group_name(user_id), event)
@@ -0,0 +1,195 @@
+import asyncio
+import time
+from collections import deque
+from uuid import uuid4
+
+from channels.exceptions import ChannelFull
+from channels.layers import BaseChannelLayer
+
+
+def _wake(waiter):
+    if not waiter.done():
+        waiter.set_result(None)
+
+
+class LocalChannel:
+    """
+    Pending messages of one channel, its receivers and its groups.
+    """
+    __slots__ = ('capacity', 'messages', 'waiters', 'groups')
+
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.messages = deque()
+        self.waiters = deque()
+        self.groups = set()
+
+    @property
+    def idle(self):
+        return not (self.messages or self.waiters or self.groups)
+
+    def expire(self, now):
+        """
+        Drop the expired messages, returning whether there was any.
+        """
+        expired = False
+        while self.messages and self.messages[0][0] < now:
+            self.messages.popleft()
+            expired = True
+        return expired
+
+    def put(self, expires_at, message):
+        self.messages.append((expires_at, message))
+        while self.waiters:
+            waiter = self.waiters.popleft()
+            if waiter.done():
+                continue
+            # Senders may run in another thread, through async_to_sync
+            loop = waiter.get_loop()
+            try:
+                running = asyncio.get_running_loop()
+            except RuntimeError:
+                running = None
+            if running is loop:
+                _wake(waiter)
+            else:
+                loop.call_soon_threadsafe(_wake, waiter)
+            break
+
+
+class LocalChannelLayer(BaseChannelLayer):
+    """
+    Channel layer of a single process, for small deployments and tests.
+
+    Unlike channels' InMemoryChannelLayer, messages aren't deep copied for
+    every receiver, groups are indexed both ways and expiry is only checked
+    on the channels being used, so a group send costs one shallow copy per
+    member whatever the number of channels and groups. Each channel holds at
+    most `capacity` messages: a group send skips full channels, like
+    RedisChannelLayer, and a channel whose messages expire unread leaves
+    its groups.
+
+    Messages aren't serialized, so they aren't checked to be
+    MessagePack-compatible as with Redis.
+    """
+
+    extensions = ['groups', 'flush']
+
+    def __init__(self, expiry=60, group_expiry=86400, capacity=100,
+                 channel_capacity=None, **kwargs):
+        super().__init__(expiry=expiry, capacity=capacity,
+                         channel_capacity=channel_capacity, **kwargs)
+        self.channel_capacity = self.compile_capacities(
+            self.channel_capacity)
+        self.group_expiry = group_expiry
+        self.channels = {}
+        # Join time of the channels of each group
+        self.groups = {}
+
+    def get_channel(self, name):
+        channel = self.channels.get(name)
+        if channel is None:
+            channel = self.channels[name] = LocalChannel(
+                self.get_capacity(name))
+        return channel
+
+    def forget_channel(self, name, channel):
+        if channel.idle and self.channels.get(name) is channel:
+            del self.channels[name]
+
+    # Channel layer API
+
+    async def send(self, channel, message):
+        assert isinstance(message, dict), 'message is not a dict'
+        assert self.valid_channel_name(channel), 'Channel name not valid'
+        assert '__asgi_channel__' not in message
+        if not self.deliver(channel, message, time.time()):
+            raise ChannelFull(channel)
+
+    def deliver(self, name, message, now, group=None):
+        channel = self.get_channel(name)
+        if channel.expire(now):
+            # Nobody reads this channel anymore
+            self.leave_groups(name, channel)
+            if group is not None:
+                self.forget_channel(name, channel)
+                return False
+        if len(channel.messages) >= channel.capacity:
+            return False
+        channel.put(now + self.expiry, dict(message))
+        return True
+
+    async def receive(self, channel):
+        assert self.valid_channel_name(channel)
+        local = self.get_channel(channel)
+        try:
+            while True:
+                local.expire(time.time())
+                if local.messages:
+                    return local.messages.popleft()[1]
+                waiter = asyncio.get_running_loop().create_future()
+                local.waiters.append(waiter)
+                try:
+                    await waiter
+                finally:
+                    if waiter in local.waiters:
+                        local.waiters.remove(waiter)
+        finally:
+            self.forget_channel(channel, local)
+
+    async def new_channel(self, prefix='specific.'):
+        return f'{prefix}.local!{uuid4().hex}'
+
+    # Flush extension
+
+    async def flush(self):
+        self.channels = {}
+        self.groups = {}
+
+    async def close(self):
+        pass
+
+    # Groups extension
+
+    async def group_add(self, group, channel):
+        assert self.valid_group_name(group), 'Group name not valid'
+        assert self.valid_channel_name(channel), 'Channel name not valid'
+        self.groups.setdefault(group, {})[channel] = time.time()
+        self.get_channel(channel).groups.add(group)
+
+    async def group_discard(self, group, channel):
+        assert self.valid_channel_name(channel), 'Invalid channel name'
+        assert self.valid_group_name(group), 'Invalid group name'
+        self.discard(group, channel)
+        local = self.channels.get(channel)
+        if local is not None:
+            self.forget_channel(channel, local)
+
+    def discard(self, group, name):
+        members = self.groups.get(group)
+        if members is not None:
+            members.pop(name, None)
+            if not members:
+                del self.groups[group]
+        channel = self.channels.get(name)
+        if channel is not None:
+            channel.groups.discard(group)
+
+    def leave_groups(self, name, channel):
+        for group in list(channel.groups):
+            self.discard(group, name)
+
+    async def group_send(self, group, message):
+        assert isinstance(message, dict), 'Message is not a dict'
+        assert self.valid_group_name(group), 'Invalid group name'
+        members = self.groups.get(group)
+        if not members:
+            return
+        now = time.time()
+        joined_after = now - self.group_expiry
+        for name, joined_at in list(members.items()):
+            if joined_at < joined_after:
+                self.discard(group, name)
+            else:
+                # Full channels miss the message
+                self.deliver(name, message, now, group)
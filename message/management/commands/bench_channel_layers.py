@@ -0,0 +1,98 @@
+import asyncio
+import statistics
+import time
+
+from asgiref.sync import async_to_sync
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.utils.module_loading import import_string
+
+LAYERS = (
+    ('in-memory (channels)', {
+        'BACKEND': 'channels.layers.InMemoryChannelLayer',
+    }),
+    ('local', settings.CHANNEL_LAYER_BACKENDS['local']),
+    ('redis', settings.CHANNEL_LAYER_BACKENDS['redis']),
+)
+
+
+class Command(BaseCommand):
+    help = ('Measure group fan-out latency and throughput of the channel '
+            'layers')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--members', type=int, default=100,
+                            help='Channels in the group')
+        parser.add_argument('--messages', type=int, default=200,
+                            help='Messages sent to the group')
+        parser.add_argument('--idle-groups', type=int, default=1000,
+                            help='Other groups with one channel each')
+        parser.add_argument('--redis', metavar='HOST:PORT',
+                            help='Redis server (or stand-in) to use instead '
+                                 'of the one of the settings')
+
+    def handle(self, *args, **options):
+        for name, config in LAYERS:
+            config = dict(config)
+            layer_options = dict(config.get('CONFIG', {}))
+            if name == 'redis' and options['redis']:
+                host, port = options['redis'].rsplit(':', 1)
+                layer_options['hosts'] = [(host, int(port))]
+            # Nothing is dropped, every layer delivers the same messages
+            layer_options['capacity'] = options['messages'] + 1
+            layer = import_string(config['BACKEND'])(**layer_options)
+
+            try:
+                elapsed, latencies = async_to_sync(self.run)(layer, options)
+            except OSError as e:
+                self.stdout.write('%-22s unavailable: %s' % (name, e))
+                continue
+            latencies.sort()
+            self.stdout.write(
+                '%-22s %9.0f deliveries/s   latency p50 %7.2f ms   '
+                'p99 %7.2f ms' % (
+                    name,
+                    len(latencies) / elapsed,
+                    statistics.median(latencies) * 1000,
+                    latencies[int(len(latencies) * 0.99)] * 1000))
+
+    async def run(self, layer, options):
+        group = 'bench'
+        channels = [await layer.new_channel()
+                    for _ in range(options['members'])]
+        idle = [await layer.new_channel()
+                for _ in range(options['idle_groups'])]
+        for channel in channels:
+            await layer.group_add(group, channel)
+        for i, channel in enumerate(idle):
+            await layer.group_add(f'idle-{i}', channel)
+
+        latencies = []
+
+        async def receiver(channel):
+            for _ in range(options['messages']):
+                message = await layer.receive(channel)
+                latencies.append(time.perf_counter() - message['sent_at'])
+
+        try:
+            receiving = asyncio.gather(
+                *(receiver(channel) for channel in channels))
+            start = time.perf_counter()
+            for i in range(options['messages']):
+                await layer.group_send(group, {
+                    'type': 'bench.message',
+                    'sent_at': time.perf_counter(),
+                    'body': 'x' * 256,
+                })
+                # Let receivers run between sends, as a consumer would
+                await asyncio.sleep(0)
+            await receiving
+            elapsed = time.perf_counter() - start
+        finally:
+            for channel in channels:
+                await layer.group_discard(group, channel)
+            for i, channel in enumerate(idle):
+                await layer.group_discard(f'idle-{i}', channel)
+            if hasattr(layer, 'close_pools'):
+                await layer.close_pools()
+        return elapsed, latencies
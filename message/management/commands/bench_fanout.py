@@ -0,0 +1,110 @@
+import os
+import time
+
+from django.core.management.base import BaseCommand
+
+from message.batching import message_event
+from message.consumers import MessageConsumerMixin
+from message.encoding import dumps_json, dumps_msgpack, loads_msgpack
+
+
+class Receiver(MessageConsumerMixin):
+    """
+    Consumer of a conversation group, without a connection.
+    """
+
+    def __init__(self, user_id, binary_frames):
+        self.scope = {'user': type('User', (), {'id': user_id})}
+        self.binary_frames = binary_frames
+
+    def encode(self, frame):
+        encoded = frame.get('encoded')
+        if encoded is not None:
+            return encoded
+        if self.binary_frames:
+            return dumps_msgpack(frame)
+        return dumps_json(frame)
+
+
+class PerRecipientReceiver(Receiver):
+    """
+    Previous fan-out: the whole event encoded again by every consumer.
+    """
+
+    def for_reader(self, event):
+        event = dict(event)
+        keys = event.pop('keys', {})
+        event['key_packet'] = keys.get(str(self.scope['user'].id))
+        return event
+
+
+class Command(BaseCommand):
+    help = ('Measure the cost of fanning a message event out to the members '
+            'of a large conversation')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--members', type=int, default=500,
+                            help='Members of the conversation')
+        parser.add_argument('--messages', type=int, default=200,
+                            help='Messages fanned out')
+        parser.add_argument('--size', type=int, default=1024,
+                            help='Size of each message in bytes')
+        parser.add_argument('--binary-share', type=float, default=0.5,
+                            help='Share of MessagePack clients')
+
+    def handle(self, *args, **options):
+        members = options['members']
+        binary_members = int(members * options['binary_share'])
+        data = {
+            'id': 1,
+            'user': 'sender',
+            'conversation': 1,
+            'sequence': 1,
+            'message': '',
+            'binary_message': os.urandom(options['size']),
+            'key_packet': None,
+            'attachments': [],
+            'created_at': time.time(),
+            'updated_at': time.time(),
+            'keys': {str(user_id): os.urandom(96).hex()
+                     for user_id in range(members)},
+        }
+
+        before = [PerRecipientReceiver(user_id, user_id < binary_members)
+                  for user_id in range(members)]
+        after = [Receiver(user_id, user_id < binary_members)
+                 for user_id in range(members)]
+
+        # Every message differs, so nothing is converted once for all
+        messages = [{**data, 'id': i, 'sequence': i}
+                    for i in range(1, options['messages'] + 1)]
+
+        def per_recipient(message):
+            event = {'type': 'chat_message', **message}
+            # The channel layer serializes events with MessagePack
+            event = loads_msgpack(dumps_msgpack(event))
+            for receiver in before:
+                receiver.encode(receiver.for_reader(event))
+
+        def encoded_once(message):
+            event = loads_msgpack(dumps_msgpack(message_event(message)))
+            for receiver in after:
+                receiver.encode(receiver.for_reader(event))
+
+        self.stdout.write(
+            f'{members} members, {binary_members} using MessagePack')
+        for name, fan_out, event in (
+                ('before (per recipient)', per_recipient,
+                 {'type': 'chat_message', **data}),
+                ('after (encoded once)', encoded_once, message_event(data))):
+            start = time.perf_counter()
+            for message in messages:
+                fan_out(message)
+            elapsed = time.perf_counter() - start
+            self.stdout.write(
+                '%-24s %8.2f ms/message   %8.0f frames/s   '
+                '%7d event bytes' % (
+                    name,
+                    elapsed / options['messages'] * 1000,
+                    options['messages'] * members / elapsed,
+                    len(dumps_msgpack(event))))
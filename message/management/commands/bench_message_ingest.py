@@ -0,0 +1,137 @@
+import asyncio
+import gc
+import statistics
+import time
+from uuid import uuid4
+
+from asgiref.sync import async_to_sync, sync_to_async
+from django.core.management.base import BaseCommand
+
+from core.models import User
+from message.consumers import MessageConsumerMixin
+from message.models import Conversation
+from message.serializers import MessageSerializer
+
+
+class SplitPipeline(MessageConsumerMixin):
+    """
+    Previous receive pipeline: validation on the event loop, then a separate
+    thread hop for the insert.
+    """
+    async def new_message(self, message, user, conversation):
+        serializer = MessageSerializer(data=message)
+        serializer.context['websocket'] = True
+        serializer.context['user'] = user
+        serializer.context['conversation'] = conversation
+
+        serializer.is_valid(raise_exception=True)
+
+        def save():
+            serializer.save()
+            # The representation reads the attachments of the message
+            return serializer.data
+        return await sync_to_async(save)()
+
+
+class SingleHopPipeline(MessageConsumerMixin):
+    """
+    Current receive pipeline of the consumers.
+    """
+
+
+PIPELINES = (
+    ('before (split)', SplitPipeline),
+    ('after (single hop)', SingleHopPipeline),
+)
+
+
+class Command(BaseCommand):
+    help = ('Measure how many websocket messages per second one worker '
+            'validates and stores, and how late the event loop runs')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--messages', type=int, default=2000,
+                            help='Messages per pipeline and round')
+        parser.add_argument('--senders', type=int, default=20,
+                            help='Concurrent senders on the event loop')
+        parser.add_argument('--size', type=int, default=1024,
+                            help='Size of each message in bytes')
+        parser.add_argument('--rounds', type=int, default=3,
+                            help='Rounds per pipeline, in alternating order')
+
+    def handle(self, *args, **options):
+        suffix = uuid4().hex[:8]
+        users = [
+            User.objects.create_user(
+                f'bench-{suffix}-{i}', None, pgp_public='bench')
+            for i in range(2)
+        ]
+        conversation = Conversation.objects.create(name=f'bench-{suffix}')
+        conversation.users.add(*users)
+
+        results = {name: [] for name, _ in PIPELINES}
+        try:
+            # Connections, caches and imports are set up before measuring
+            for _, pipeline in PIPELINES:
+                async_to_sync(self.run)(pipeline(), users[0], conversation,
+                                        {**options, 'messages': 50})
+            for round_ in range(options['rounds']):
+                order = PIPELINES if round_ % 2 == 0 else PIPELINES[::-1]
+                for name, pipeline in order:
+                    # Don't bill a collection of the previous round
+                    gc.collect()
+                    results[name].append(async_to_sync(self.run)(
+                        pipeline(), users[0], conversation, options))
+        finally:
+            conversation.delete()
+            for user in users:
+                user.delete()
+
+        for name, _ in PIPELINES:
+            rounds = results[name]
+            self.stdout.write(
+                '%-20s %6.0f messages/s   loop lag p50 %5.2f ms   '
+                'p99 %6.2f ms   max %6.1f ms' % (
+                    name,
+                    statistics.median(
+                        options['messages'] / elapsed
+                        for elapsed, _ in rounds),
+                    statistics.median(
+                        percentile(lags, 0.5) for _, lags in rounds) * 1000,
+                    statistics.median(
+                        percentile(lags, 0.99) for _, lags in rounds) * 1000,
+                    max(lags[-1] for _, lags in rounds) * 1000))
+        # Garbage collections stop every thread: the maximum mostly tells
+        # which round a full collection happened in
+        self.stdout.write('Medians over %d rounds, max over all of them' %
+                          options['rounds'])
+
+    async def run(self, pipeline, user, conversation, options):
+        payload = {'message': 'x' * options['size']}
+        per_sender = options['messages'] // options['senders']
+
+        async def sender():
+            for _ in range(per_sender):
+                await pipeline.new_message(payload, user, conversation)
+
+        # How late a 1ms ticker wakes up tells how long the loop was blocked
+        # for the other sockets of the worker
+        lags = []
+
+        async def ticker():
+            while True:
+                before = time.perf_counter()
+                await asyncio.sleep(0.001)
+                lags.append(time.perf_counter() - before - 0.001)
+
+        ticking = asyncio.ensure_future(ticker())
+        start = time.perf_counter()
+        await asyncio.gather(*(sender() for _ in range(options['senders'])))
+        elapsed = time.perf_counter() - start
+        ticking.cancel()
+        lags.sort()
+        return elapsed, lags
+
+
+def percentile(values, fraction):
+    return values[min(int(len(values) * fraction), len(values) - 1)]
@@ -0,0 +1,19 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from message.models import MessageTombstone
+
+
+class Command(BaseCommand):
+    help = ('Delete the tombstones of messages deleted longer than '
+            'MESSAGE_TOMBSTONE_RETENTION ago')
+
+    def handle(self, *args, **options):
+        horizon = timezone.now() - settings.MESSAGE_TOMBSTONE_RETENTION
+        count, _ = (MessageTombstone.objects
+                                    .filter(deleted_at__lt=horizon)
+                                    .delete())
+
+        self.stdout.write(self.style.SUCCESS(
+            f'Deleted {count} message tombstones'))
@@ -0,0 +1,28 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from message.models import Conversation
+
+
+class Command(BaseCommand):
+    help = 'Rebuild the denormalized summary of every conversation'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            'conversation_ids',
+            nargs='*',
+            type=int,
+            help='Only rebuild these conversations',
+        )
+
+    def handle(self, *args, **options):
+        conversations = Conversation.objects.all()
+        if options['conversation_ids']:
+            conversations = conversations.filter(
+                pk__in=options['conversation_ids'])
+
+        with transaction.atomic():
+            count = conversations.rebuild_summaries()
+
+        self.stdout.write(self.style.SUCCESS(
+            f'Rebuilt {count} conversation summaries'))
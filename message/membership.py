@@ -0,0 +1,59 @@
+"""
+Cached conversation memberships, stored under a version of the members of
+their conversation. Membership changes drop the version once they commit,
+so an answer read before the commit and cached after it is never used.
+"""
+from uuid import uuid4
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+
+from message.models import Conversation
+
+
+def version_key(conversation_id):
+    return f'conversation_members_version:{conversation_id}'
+
+
+def membership_key(user_id, conversation_id, version):
+    return f'conversation_member:{conversation_id}:{version}:{user_id}'
+
+
+def get_version(conversation_id):
+    key = version_key(conversation_id)
+    version = cache.get(key)
+    if version is None:
+        version = uuid4().hex
+        if not cache.add(key, version, settings.MEMBERSHIP_CACHE_TTL):
+            # Set by a concurrent request
+            version = cache.get(key) or version
+    return version
+
+
+def is_member(user_id, conversation_id):
+    """
+    Whether a user belongs to a conversation, from the cache or else an
+    EXISTS query whose answer is cached.
+    """
+    # Read before the query: if members change in between, the answer is
+    # cached under a version which is already dropped
+    key = membership_key(user_id, conversation_id,
+                         get_version(conversation_id))
+    member = cache.get(key)
+    if member is None:
+        member = Conversation.users.through.objects.filter(
+            user_id=user_id, conversation_id=conversation_id).exists()
+        cache.set(key, member, settings.MEMBERSHIP_CACHE_TTL)
+    return member
+
+
+def forget_memberships(pairs):
+    """
+    Drop the cached memberships of the conversations of `(user_id,
+    conversation_id)` pairs once the current transaction commits.
+    """
+    keys = list({version_key(conversation_id)
+                 for _, conversation_id in pairs})
+    if keys:
+        transaction.on_commit(lambda: cache.delete_many(keys))
@@ -0,0 +1,41 @@
+"""
+Versions of the lists of messages sent by each user, so that polling them
+costs a cache read. Creating, editing or deleting messages of a user drops
+their version, and the next list gets a new one.
+"""
+from uuid import uuid4
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+from django.utils import timezone
+
+
+def version_key(user_id):
+    return f'message_list_version:{user_id}'
+
+
+def get_version(user_id):
+    """
+    Return the list version of a user, and when it was set: no earlier
+    than the last change of their messages.
+    """
+    key = version_key(user_id)
+    version = cache.get(key)
+    if version is None:
+        version = (uuid4().hex, timezone.now())
+        if not cache.add(key, version, settings.MESSAGE_LIST_VERSION_TTL):
+            # Set by a concurrent request
+            version = cache.get(key) or version
+    return version
+
+
+def invalidate_users(user_ids):
+    """
+    Drop the list versions of some users, now and once the current
+    transaction commits, so no list read before the commit is served.
+    """
+    keys = [version_key(user_id) for user_id in set(user_ids)]
+    if keys:
+        cache.delete_many(keys)
+        transaction.on_commit(lambda: cache.delete_many(keys))
@@ -0,0 +1,60 @@
+# Generated by Django 3.2 on 2026-10-18 08:28
+
+from django.conf import settings
+from django.db import migrations, models
+from django.db.models import Count, Max, OuterRef, Subquery
+from django.db.models.functions import Coalesce
+import django.db.models.deletion
+
+
+def build_summaries(apps, schema_editor):
+    Conversation = apps.get_model('message', 'Conversation')
+    Message = apps.get_model('message', 'Message')
+    messages = Message.objects.filter(conversation=OuterRef('pk'))
+    latest = messages.order_by('-created_at', '-id')
+    count = (messages.order_by()
+                     .values('conversation')
+                     .annotate(count=Count('id'))
+                     .values('count'))
+    last_activity = (messages.order_by()
+                             .values('conversation')
+                             .annotate(last=Max('updated_at'))
+                             .values('last'))
+    Conversation.objects.update(
+        message_count=Coalesce(Subquery(count), 0),
+        last_message=Subquery(latest.values('id')[:1]),
+        last_user=Subquery(latest.values('user')[:1]),
+        last_activity=Subquery(last_activity),
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('message', '0005_message_message_conversation_history'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='conversation',
+            name='last_activity',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='conversation',
+            name='last_message',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to='message.message'),
+        ),
+        migrations.AddField(
+            model_name='conversation',
+            name='last_user',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to=settings.AUTH_USER_MODEL),
+        ),
+        migrations.AddField(
+            model_name='conversation',
+            name='message_count',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.RunPython(build_summaries, migrations.RunPython.noop),
+    ]
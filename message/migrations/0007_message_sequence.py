@@ -0,0 +1,56 @@
+# Generated by Django 3.2 on 2026-10-18 08:40
+
+from django.db import migrations, models
+
+
+# Messages numbered per UPDATE
+BATCH_SIZE = 1000
+
+
+def number_messages(apps, schema_editor):
+    Conversation = apps.get_model('message', 'Conversation')
+    Message = apps.get_model('message', 'Message')
+    conversation_ids = list(Conversation.objects.values_list('id', flat=True))
+    for conversation_id in conversation_ids:
+        message_ids = list(Message.objects
+                                  .filter(conversation_id=conversation_id)
+                                  .order_by('created_at', 'id')
+                                  .values_list('id', flat=True))
+        for start in range(0, len(message_ids), BATCH_SIZE):
+            Message.objects.bulk_update([
+                Message(id=message_id, sequence=sequence)
+                for sequence, message_id in enumerate(
+                    message_ids[start:start + BATCH_SIZE], start + 1)
+            ], ['sequence'])
+        Conversation.objects.filter(pk=conversation_id).update(
+            last_sequence=len(message_ids))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('message', '0006_conversation_summary'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='conversation',
+            name='last_sequence',
+            field=models.PositiveBigIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='message',
+            name='sequence',
+            field=models.PositiveBigIntegerField(editable=False, null=True),
+        ),
+        migrations.RunPython(number_messages, migrations.RunPython.noop),
+        migrations.AlterField(
+            model_name='message',
+            name='sequence',
+            field=models.PositiveBigIntegerField(editable=False),
+        ),
+        migrations.AddConstraint(
+            model_name='message',
+            constraint=models.UniqueConstraint(fields=('conversation', 'sequence'), name='unique_message_sequence'),
+        ),
+    ]
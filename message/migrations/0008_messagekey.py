@@ -0,0 +1,29 @@
+# Generated by Django 3.2 on 2026-10-18 08:36
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('message', '0007_message_sequence'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='MessageKey',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('key_packet', models.TextField()),
+                ('message', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='keys', to='message.message')),
+                ('recipient', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to=settings.AUTH_USER_MODEL)),
+            ],
+        ),
+        migrations.AddConstraint(
+            model_name='messagekey',
+            constraint=models.UniqueConstraint(fields=('message', 'recipient'), name='unique_message_key'),
+        ),
+    ]
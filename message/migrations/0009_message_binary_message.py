@@ -0,0 +1,18 @@
+# Generated by Django 3.2 on 2026-10-18 08:38
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('message', '0008_messagekey'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='message',
+            name='binary_message',
+            field=models.BinaryField(blank=True, editable=True, null=True),
+        ),
+    ]
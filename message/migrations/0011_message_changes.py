@@ -0,0 +1,41 @@
+# Generated by Django 3.2 on 2026-10-18 08:53
+
+from django.db import migrations, models
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('message', '0010_attachment'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='MessageTombstone',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('message_id', models.IntegerField()),
+                ('conversation_id', models.IntegerField()),
+                ('user_id', models.IntegerField()),
+                ('sequence', models.PositiveBigIntegerField()),
+                ('deleted_at', models.DateTimeField(default=django.utils.timezone.now)),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name='message',
+            index=models.Index(fields=['conversation', 'updated_at', 'id'], name='message_conversation_changes'),
+        ),
+        migrations.AddIndex(
+            model_name='message',
+            index=models.Index(fields=['user', 'updated_at', 'id'], name='message_user_changes'),
+        ),
+        migrations.AddIndex(
+            model_name='messagetombstone',
+            index=models.Index(fields=['conversation_id', 'deleted_at'], name='tombstone_conversation'),
+        ),
+        migrations.AddIndex(
+            model_name='messagetombstone',
+            index=models.Index(fields=['user_id', 'deleted_at'], name='tombstone_user'),
+        ),
+    ]
@@ -1,3 +1,21 @@
+import hashlib
+import time
+from datetime import datetime, timezone as dt_timezone
+
+from django.conf import settings
+from django.db.models import Q
+from django.utils import timezone
+from django.utils.cache import get_conditional_response
+from django.utils.http import http_date
+from rest_framework import status
+from rest_framework.exceptions import APIException, ValidationError
+from rest_framework.response import Response
+from rest_framework.settings import api_settings
+
+from message.models import MessageTombstone
+from message.renderers import MessagePackParser, MessagePackRenderer
+
+
 class ReadWriteSerializerMixin(object):
     """
     Overrides get_serializer_class to choose the read serializer
@@ -30,3 +48,145 @@ class ReadWriteSerializerMixin(object):
             % self.__class__.__name__
         )
         return self.write_serializer_class
+
+
+class MessagePackMixin(object):
+    """
+    Lets clients negotiate MessagePack request and response bodies, in
+    which binary fields travel as raw bytes instead of base64 text.
+    """
+
+    renderer_classes = api_settings.DEFAULT_RENDERER_CLASSES + [
+        MessagePackRenderer]
+    parser_classes = api_settings.DEFAULT_PARSER_CLASSES + [
+        MessagePackParser]
+
+    def get_serializer_context(self):
+        context = super().get_serializer_context()
+        renderer = getattr(self.request, 'accepted_renderer', None)
+        context['binary'] = isinstance(renderer, MessagePackRenderer)
+        return context
+
+
+class ChangesExpired(APIException):
+    status_code = status.HTTP_410_GONE
+    default_detail = ('Deletions are only kept for a limited time, '
+                      'the messages must be listed again')
+    default_code = 'changes_expired'
+
+
+class MessageChangesMixin(object):
+    """
+    Conditional message lists, and delta sync with `changed_since`.
+
+    Lists get an ETag and a Last-Modified date from `get_list_version()`,
+    so clients polling them with If-None-Match or If-Modified-Since get a
+    304 Not Modified until a message is created, edited or deleted.
+
+    `?changed_since=<timestamp>` lists the messages created or edited since
+    then (clients upsert them by id), and the `deleted` ones as tombstones
+    from `get_tombstones()`. `until` is the timestamp to send as the next
+    `changed_since`, with `after` when it is set: the id of the last message
+    of a page, which other messages may share the timestamp with.
+    """
+
+    changes_page_size = 200
+
+    def get_list_version(self):
+        """
+        Return a string which changes with the listed messages, and the
+        datetime of their last change (or None). Lists without a version
+        aren't conditional.
+        """
+        return None, None
+
+    def get_tombstones(self):
+        return MessageTombstone.objects.none()
+
+    def list(self, request, *args, **kwargs):
+        version, last_modified = self.get_list_version()
+        headers = {}
+        if version is not None:
+            # The body also depends on the query and the negotiated format
+            etag = '"%s"' % hashlib.md5('|'.join((
+                version,
+                request.get_full_path(),
+                request.accepted_renderer.format,
+            )).encode('utf-8')).hexdigest()
+            headers['ETag'] = etag
+            if last_modified is not None:
+                # Dates have whole seconds: until the second of the last
+                # change is over, another change could share it and be
+                # missed by If-Modified-Since. Only the ETag is given then.
+                last_modified = int(last_modified.timestamp())
+                if last_modified < int(time.time()):
+                    headers['Last-Modified'] = http_date(last_modified)
+                else:
+                    last_modified = None
+
+            if get_conditional_response(request, etag=etag,
+                                        last_modified=last_modified):
+                return Response(status=status.HTTP_304_NOT_MODIFIED,
+                                headers=headers)
+
+        if 'changed_since' in request.query_params:
+            response = self.list_changes(request.query_params['changed_since'],
+                                         request.query_params.get('after'))
+        else:
+            response = super().list(request, *args, **kwargs)
+        for header, value in headers.items():
+            response[header] = value
+        return response
+
+    def list_changes(self, changed_since, after=None):
+        try:
+            # Timestamps of the epoch in float seconds keep their
+            # microseconds, `until` comes back exactly as it was sent
+            since = datetime.fromtimestamp(float(changed_since),
+                                           dt_timezone.utc)
+        except (ValueError, OverflowError, OSError):
+            raise ValidationError({'changed_since': 'Invalid timestamp'})
+        if after is not None:
+            try:
+                after = int(after)
+            except ValueError:
+                raise ValidationError({'after': 'Invalid message id'})
+        if since < timezone.now() - settings.MESSAGE_TOMBSTONE_RETENTION:
+            raise ChangesExpired()
+
+        until = max(since, timezone.now() - settings.MESSAGE_CHANGES_LAG)
+        messages = (self.filter_queryset(self.get_queryset())
+                        .filter(updated_at__lt=until))
+        if after is None:
+            messages = messages.filter(updated_at__gte=since)
+        else:
+            messages = messages.filter(Q(updated_at__gt=since) |
+                                       Q(updated_at=since, pk__gt=after))
+        messages = list(messages.order_by('updated_at', 'id')
+                                [:self.changes_page_size + 1])
+        has_more = len(messages) > self.changes_page_size
+        if has_more:
+            messages = messages[:self.changes_page_size]
+            # The next page starts after the last message of this one
+            until = messages[-1].updated_at
+            after = messages[-1].id
+        else:
+            after = None
+
+        deleted = (self.get_tombstones()
+                       .filter(deleted_at__gte=since, deleted_at__lt=until)
+                       .order_by('deleted_at', 'id'))
+        return Response({
+            'results': self.get_serializer(messages, many=True).data,
+            'deleted': [
+                {
+                    'id': tombstone.message_id,
+                    'conversation': tombstone.conversation_id,
+                    'sequence': tombstone.sequence,
+                }
+                for tombstone in deleted
+            ],
+            'until': until.timestamp(),
+            'after': after,
+            'has_more': has_more,
+        })
@@ -1,15 +1,229 @@
-from django.db import models
+import uuid
+from django.db import connections, models, transaction
+from django.db.models import (
+    Count,
+    F,
+    Max,
+    OuterRef,
+    Prefetch,
+    Subquery,
+    Value
+)
+from django.db.models import sql
+from django.db.models.functions import Coalesce, Greatest
+from django.utils import timezone
 from core.models import User
 
 
+def can_return_from_update(connection):
+    if connection.vendor == 'postgresql':
+        return True
+    if connection.vendor == 'sqlite':
+        return connection.Database.sqlite_version_info >= (3, 35)
+    return False
+
+
+class ConversationQuerySet(models.QuerySet):
+    def rebuild_summaries(self):
+        """
+        Recompute the denormalized summary of every conversation in the
+        queryset from the message table.
+        """
+        messages = Message.objects.filter(conversation=OuterRef('pk'))
+        latest = messages.order_by('-created_at', '-id')
+        count = (messages.order_by()
+                         .values('conversation')
+                         .annotate(count=Count('id'))
+                         .values('count'))
+        last_activity = (messages.order_by()
+                                 .values('conversation')
+                                 .annotate(last=Max('updated_at'))
+                                 .values('last'))
+        last_sequence = (messages.order_by()
+                                 .values('conversation')
+                                 .annotate(last=Max('sequence'))
+                                 .values('last'))
+        return self.update(
+            message_count=Coalesce(Subquery(count), 0),
+            # Sequence numbers of deleted messages are never reused
+            last_sequence=Greatest(
+                F('last_sequence'), Coalesce(Subquery(last_sequence), 0)),
+            last_message=Subquery(latest.values('id')[:1]),
+            last_user=Subquery(latest.values('user')[:1]),
+            last_activity=Subquery(last_activity),
+        )
+
+    def allocate_sequences(self, conversation_id, count, last_user_id,
+                           last_activity):
+        """
+        Reserve `count` consecutive message sequence numbers in a
+        conversation for messages of `last_user_id` sent at `last_activity`,
+        add them to its summary and return the first reserved number.
+
+        Must run inside a transaction: the update locks the conversation
+        row until commit, which serializes concurrent writers and keeps the
+        sequence gap-free if the transaction rolls back.
+        """
+        conversations = self.filter(pk=conversation_id)
+        values = {
+            'last_sequence': F('last_sequence') + count,
+            'message_count': F('message_count') + count,
+            'last_user': last_user_id,
+            'last_activity': last_activity,
+        }
+        connection = connections[self.db]
+        if can_return_from_update(connection):
+            # The update returns the sequence, in a single round trip
+            query = conversations.query.chain(sql.UpdateQuery)
+            query.add_update_values(values)
+            update, params = query.get_compiler(self.db).as_sql()
+            with connection.cursor() as cursor:
+                cursor.execute('%s RETURNING %s' % (
+                    update, connection.ops.quote_name('last_sequence')),
+                    params)
+                last_sequence = cursor.fetchone()[0]
+        else:
+            conversations.update(**values)
+            last_sequence = conversations.values_list(
+                'last_sequence', flat=True).get()
+        return last_sequence - count + 1
+
+    def recount_messages(self):
+        """
+        Update the summary of conversations which lost messages.
+        """
+        count = (Message.objects
+                        .filter(conversation=OuterRef('pk'))
+                        .order_by()
+                        .values('conversation')
+                        .annotate(count=Count('id'))
+                        .values('count'))
+        self.update(
+            message_count=Coalesce(Subquery(count), 0),
+            last_activity=timezone.now(),
+        )
+        return self.refresh_last_message()
+
+    def refresh_last_message(self):
+        """
+        Point the conversations which lost their last message to the
+        latest remaining one.
+        """
+        latest = (Message.objects
+                         .filter(conversation=OuterRef('pk'))
+                         .order_by('-created_at', '-id'))
+        return self.filter(last_message__isnull=True).update(
+            last_message=Subquery(latest.values('id')[:1]),
+            last_user=Subquery(latest.values('user')[:1]),
+        )
+
+
 class Conversation(models.Model):
     users = models.ManyToManyField(User, related_name="conversations")
     name = models.CharField(max_length=64, blank=True)
 
+    # Summary of the conversation messages, kept up to date by Message
+    last_message = models.ForeignKey('Message',
+                                     on_delete=models.SET_NULL,
+                                     null=True,
+                                     blank=True,
+                                     related_name='+')
+    last_user = models.ForeignKey(User,
+                                  on_delete=models.SET_NULL,
+                                  null=True,
+                                  blank=True,
+                                  related_name='+')
+    message_count = models.PositiveIntegerField(default=0)
+    last_sequence = models.PositiveBigIntegerField(default=0)
+    last_activity = models.DateTimeField(null=True, blank=True)
+
+    objects = ConversationQuerySet.as_manager()
+
     def __str__(self) -> str:
         return self.name
 
 
+def attachment_path(instance, filename):
+    return f'attachments/{instance.id}'
+
+
+class Attachment(models.Model):
+    """
+    Encrypted file uploaded in chunks to a conversation, then referenced by
+    messages. Chunks are appended in order: `received` is the offset at
+    which an interrupted upload resumes.
+    """
+    id = models.UUIDField(primary_key=True, default=uuid.uuid4,
+                          editable=False)
+    conversation = models.ForeignKey(Conversation,
+                                     on_delete=models.CASCADE,
+                                     related_name="attachments")
+    user = models.ForeignKey(User, on_delete=models.CASCADE)
+    file = models.FileField(upload_to=attachment_path)
+    size = models.PositiveBigIntegerField()
+    received = models.PositiveBigIntegerField(default=0)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    @property
+    def complete(self):
+        return self.received == self.size
+
+    def __str__(self) -> str:
+        return str(self.id)
+
+
+class MessageQuerySet(models.QuerySet):
+    def delete(self):
+        # Tombstones and summaries are written once for all the messages
+        from message.deletion import bulk_deletion
+        with transaction.atomic(using=self.db), bulk_deletion():
+            return super().delete()
+
+    delete.alters_data = True
+    delete.queryset_only = True
+
+    def for_reader(self, user):
+        """
+        Prefetch the session key packet of `user` only, as `own_keys`,
+        and the attachments.
+        """
+        return self.select_related('user').prefetch_related(Prefetch(
+            'keys',
+            queryset=MessageKey.objects.filter(recipient=user),
+            to_attr='own_keys'
+        ), 'attachments')
+
+    def create_batch(self, conversation_id, messages):
+        """
+        Insert unsaved messages of one conversation with a single bulk
+        insert. They get consecutive sequence numbers, in list order.
+        """
+        if not messages:
+            return messages
+
+        with transaction.atomic():
+            first = Conversation.objects.allocate_sequences(
+                conversation_id, len(messages), messages[-1].user_id,
+                timezone.now())
+            for offset, message in enumerate(messages):
+                message.conversation_id = conversation_id
+                message.sequence = first + offset
+            self.bulk_create(messages)
+
+            if messages[0].pk is None:
+                # The backend can't return the ids of bulk inserted rows
+                ids = dict(self.filter(conversation=conversation_id,
+                                       sequence__gte=first,
+                                       sequence__lt=first + len(messages))
+                               .values_list('sequence', 'id'))
+                for message in messages:
+                    message.pk = ids[message.sequence]
+
+            Conversation.objects.filter(pk=conversation_id).update(
+                last_message=messages[-1].pk)
+        return messages
+
+
 class Message(models.Model):
     user = models.ForeignKey(User, on_delete=models.CASCADE, null=False)
     conversation = models.ForeignKey(Conversation,
@@ -17,5 +231,145 @@ class Message(models.Model):
                                      null=False,
                                      related_name="messages")
     message = models.TextField(null=False, blank=True)
+    # Non-armored ciphertext, for clients using a binary encoding
+    binary_message = models.BinaryField(null=True, blank=True, editable=True)
+    attachments = models.ManyToManyField(Attachment,
+                                         blank=True,
+                                         related_name="messages")
+    # Gap-free position of the message in its conversation
+    sequence = models.PositiveBigIntegerField(editable=False)
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
+
+    objects = MessageQuerySet.as_manager()
+
+    def save(self, *args, **kwargs):
+        created = self._state.adding
+        with transaction.atomic():
+            if created and self.sequence is None:
+                self.sequence = Conversation.objects.allocate_sequences(
+                    self.conversation_id, 1, self.user_id, timezone.now())
+            super().save(*args, **kwargs)
+            conversations = Conversation.objects.filter(
+                pk=self.conversation_id)
+            if created:
+                # The id is only known once inserted
+                conversations.update(last_message=self.id)
+            else:
+                conversations.update(last_activity=self.updated_at)
+
+    def build_keys(self, keys):
+        """
+        Build the key packets of the message from a {user id: key packet}
+        mapping, remembering it as `recipient_keys`.
+        """
+        self.recipient_keys = keys
+        return [
+            MessageKey(message=self, recipient_id=user_id, key_packet=packet)
+            for user_id, packet in keys.items()
+        ]
+
+    class Meta:
+        indexes = [
+            # Backs the keyset pagination of a conversation history
+            models.Index(fields=['conversation', 'created_at', 'id'],
+                         name='message_conversation_history'),
+            # Back the changed_since queries
+            models.Index(fields=['conversation', 'updated_at', 'id'],
+                         name='message_conversation_changes'),
+            models.Index(fields=['user', 'updated_at', 'id'],
+                         name='message_user_changes'),
+        ]
+        constraints = [
+            models.UniqueConstraint(fields=['conversation', 'sequence'],
+                                    name='unique_message_sequence'),
+        ]
+
+
+class MessageKey(models.Model):
+    """
+    Session key packet of a message encrypted to one recipient. The message
+    body holds the ciphertext shared by every recipient.
+    """
+    message = models.ForeignKey(Message,
+                                on_delete=models.CASCADE,
+                                related_name="keys")
+    recipient = models.ForeignKey(User,
+                                  on_delete=models.CASCADE,
+                                  related_name="+")
+    key_packet = models.TextField()
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['message', 'recipient'],
+                                    name='unique_message_key'),
+        ]
+
+
+class ReadCursorQuerySet(models.QuerySet):
+    def advance(self, conversation_id, user_id, read=0, delivered=0):
+        """
+        Move the cursor of a member forward to the given sequences. Cursors
+        never move backwards, and read messages count as delivered.
+        """
+        delivered = max(read, delivered)
+        cursors = self.filter(conversation_id=conversation_id, user_id=user_id)
+        changes = {
+            'read_sequence': Greatest(
+                'read_sequence', Value(read),
+                output_field=models.PositiveBigIntegerField()),
+            'delivered_sequence': Greatest(
+                'delivered_sequence', Value(delivered),
+                output_field=models.PositiveBigIntegerField()),
+            'updated_at': timezone.now(),
+        }
+        if not cursors.update(**changes):
+            self.bulk_create([ReadCursor(conversation_id=conversation_id,
+                                         user_id=user_id)],
+                             ignore_conflicts=True)
+            cursors.update(**changes)
+
+
+class ReadCursor(models.Model):
+    """
+    Sequence of the last message of a conversation delivered to and read by
+    one of its members.
+    """
+    conversation = models.ForeignKey(Conversation,
+                                     on_delete=models.CASCADE,
+                                     related_name="cursors")
+    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name="+")
+    delivered_sequence = models.PositiveBigIntegerField(default=0)
+    read_sequence = models.PositiveBigIntegerField(default=0)
+    updated_at = models.DateTimeField(default=timezone.now)
+
+    objects = ReadCursorQuerySet.as_manager()
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['conversation', 'user'],
+                                    name='unique_read_cursor'),
+        ]
+
+
+class MessageTombstone(models.Model):
+    """
+    Trace of a deleted message, so clients syncing changes learn about the
+    deletion.
+
+    The ids aren't foreign keys: tombstones are written while a deleted
+    conversation or user cascades to its messages.
+    """
+    message_id = models.IntegerField()
+    conversation_id = models.IntegerField()
+    user_id = models.IntegerField()
+    sequence = models.PositiveBigIntegerField()
+    deleted_at = models.DateTimeField(default=timezone.now)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['conversation_id', 'deleted_at'],
+                         name='tombstone_conversation'),
+            models.Index(fields=['user_id', 'deleted_at'],
+                         name='tombstone_user'),
+        ]
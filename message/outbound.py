@@ -0,0 +1,141 @@
+import asyncio
+import itertools
+import logging
+from collections import OrderedDict
+
+logger = logging.getLogger(__name__)
+
+
+class OutboundMetrics:
+    """
+    Outbound queue counters of this process.
+    """
+
+    def __init__(self):
+        self.connections = 0
+        self.depth = 0
+        self.max_depth = 0
+        self.sent = 0
+        self.coalesced = 0
+        self.dropped = 0
+        self.overflows = 0
+
+    def snapshot(self):
+        return dict(vars(self))
+
+
+metrics = OutboundMetrics()
+
+
+class OutboundQueue:
+    """
+    Bounded queue of the frames sent to one websocket client, drained by a
+    writer task so a slow client never blocks its consumer.
+
+    Frames with a coalescing `key` replace the pending frame with the same
+    key (or are merged into it with `merge`). When the queue is full,
+    pending ephemeral frames are dropped first. If there is none, the queue
+    overflows: `on_overflow` is called and later frames are discarded.
+
+    Frames the server produces at its own pace, like a replay, wait for
+    room with `wait_for_room()` instead of overflowing.
+    """
+
+    def __init__(self, maxsize, send, on_overflow):
+        self.maxsize = maxsize
+        self.send = send
+        self.on_overflow = on_overflow
+        self.frames = OrderedDict()
+        self.ids = itertools.count()
+        self.ready = asyncio.Event()
+        # Set when the writer takes a frame, or the queue closes
+        self.room = asyncio.Event()
+        self.closed = False
+        # Sequence of the last message written per conversation, which
+        # clients resume from
+        self.sent_sequences = {}
+        self.writer = asyncio.ensure_future(self.write())
+        metrics.connections += 1
+
+    def put(self, frame, key=None, ephemeral=False, merge=None):
+        if self.closed:
+            return
+
+        if key is not None and key in self.frames:
+            pending, pending_ephemeral = self.frames[key]
+            if merge is not None:
+                frame = merge(pending, frame)
+            self.frames[key] = (frame, pending_ephemeral and ephemeral)
+            metrics.coalesced += 1
+            return
+
+        if len(self.frames) >= self.maxsize and not self.drop_ephemeral():
+            self.overflow()
+            return
+
+        self.frames[next(self.ids) if key is None else key] = (
+            frame, ephemeral)
+        metrics.depth += 1
+        metrics.max_depth = max(metrics.max_depth, len(self.frames))
+        self.ready.set()
+
+    async def wait_for_room(self):
+        """
+        Wait until a frame can be put without overflowing. Return False if
+        the queue closed meanwhile.
+        """
+        while not self.closed and len(self.frames) >= self.maxsize:
+            self.room.clear()
+            await self.room.wait()
+        return not self.closed
+
+    def drop_ephemeral(self):
+        for key, (_, ephemeral) in self.frames.items():
+            if ephemeral:
+                del self.frames[key]
+                metrics.depth -= 1
+                metrics.dropped += 1
+                return True
+        return False
+
+    def overflow(self):
+        metrics.overflows += 1
+        logger.warning('Outbound queue overflow (%d frames), disconnecting',
+                       len(self.frames))
+        self.close()
+        asyncio.ensure_future(self.on_overflow(dict(self.sent_sequences)))
+
+    async def write(self):
+        while True:
+            await self.ready.wait()
+            while self.frames:
+                _, (frame, _) = self.frames.popitem(last=False)
+                metrics.depth -= 1
+                self.room.set()
+                await self.send(frame)
+                self.track(frame)
+                metrics.sent += 1
+            self.ready.clear()
+
+    def track(self, frame):
+        if frame.get('type') == 'chat_message':
+            messages = [frame]
+        elif frame.get('type') == 'sync':
+            messages = frame['messages']
+        else:
+            return
+        for message in messages:
+            conversation_id = message['conversation']
+            self.sent_sequences[conversation_id] = max(
+                self.sent_sequences.get(conversation_id, 0),
+                message['sequence'])
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        self.writer.cancel()
+        self.room.set()
+        metrics.depth -= len(self.frames)
+        metrics.connections -= 1
+        self.frames.clear()
@@ -0,0 +1,160 @@
+from collections import OrderedDict
+
+from django.db.models import Q
+from rest_framework.compat import coreapi, coreschema
+from rest_framework.exceptions import NotFound, ValidationError
+from rest_framework.pagination import BasePagination, _positive_int
+from rest_framework.response import Response
+from rest_framework.utils.urls import remove_query_param, replace_query_param
+
+
+class MessageKeysetPagination(BasePagination):
+    """
+    Keyset pagination over a conversation history ordered by
+    (created_at, id).
+
+    Without any parameter the latest page is returned. `before=<id>` walks
+    back through older messages and `after=<id>` catches up on newer ones.
+    Each page only reads `page_size` rows of the (conversation, created_at,
+    id) index, whatever the history depth. Results are always returned in
+    chronological order.
+    """
+    page_size = 50
+    max_page_size = 200
+    page_size_query_param = 'page_size'
+    before_query_param = 'before'
+    after_query_param = 'after'
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.request = request
+        self.page_size = self.get_page_size(request)
+        before = self.get_anchor_id(request, self.before_query_param)
+        after = self.get_anchor_id(request, self.after_query_param)
+
+        if before is not None and after is not None:
+            raise ValidationError(
+                "'before' and 'after' can't be used together")
+
+        if after is not None:
+            created_at, pk = self.get_anchor(queryset, after)
+            queryset = queryset.filter(
+                Q(created_at__gt=created_at) |
+                Q(created_at=created_at, id__gt=pk)
+            ).order_by('created_at', 'id')
+            page = list(queryset[:self.page_size + 1])
+            self.has_newer = len(page) > self.page_size
+            self.has_older = True
+            self.page = page[:self.page_size]
+        else:
+            if before is not None:
+                created_at, pk = self.get_anchor(queryset, before)
+                queryset = queryset.filter(
+                    Q(created_at__lt=created_at) |
+                    Q(created_at=created_at, id__lt=pk)
+                )
+            queryset = queryset.order_by('-created_at', '-id')
+            page = list(queryset[:self.page_size + 1])
+            self.has_older = len(page) > self.page_size
+            self.has_newer = before is not None
+            self.page = page[:self.page_size][::-1]
+
+        return self.page
+
+    def get_paginated_response(self, data):
+        return Response(OrderedDict([
+            ('next', self.get_next_link()),
+            ('previous', self.get_previous_link()),
+            ('results', data),
+        ]))
+
+    def get_paginated_response_schema(self, schema):
+        return {
+            'type': 'object',
+            'properties': {
+                'next': {
+                    'type': 'string',
+                    'nullable': True,
+                },
+                'previous': {
+                    'type': 'string',
+                    'nullable': True,
+                },
+                'results': schema,
+            },
+        }
+
+    def get_page_size(self, request):
+        try:
+            return _positive_int(
+                request.query_params[self.page_size_query_param],
+                strict=True,
+                cutoff=self.max_page_size
+            )
+        except (KeyError, ValueError):
+            return self.page_size
+
+    def get_anchor_id(self, request, param):
+        value = request.query_params.get(param)
+        if value is None:
+            return None
+        try:
+            return _positive_int(value, strict=True)
+        except ValueError:
+            raise ValidationError(f"'{param}' must be a message id")
+
+    def get_anchor(self, queryset, pk):
+        # The anchor has to belong to the paginated queryset, so a client
+        # can't probe messages of conversations it isn't part of.
+        anchor = queryset.filter(pk=pk).values_list('created_at', 'id').first()
+        if anchor is None:
+            raise NotFound(f'Message {pk} not found')
+        return anchor
+
+    def get_next_link(self):
+        if not self.has_newer or not self.page:
+            return None
+        url = self.request.build_absolute_uri()
+        url = remove_query_param(url, self.before_query_param)
+        return replace_query_param(
+            url, self.after_query_param, self.page[-1].id)
+
+    def get_previous_link(self):
+        if not self.has_older or not self.page:
+            return None
+        url = self.request.build_absolute_uri()
+        url = remove_query_param(url, self.after_query_param)
+        return replace_query_param(
+            url, self.before_query_param, self.page[0].id)
+
+    def get_schema_fields(self, view):
+        assert coreapi is not None, 'coreapi must be installed to use `get_schema_fields()`'
+        assert coreschema is not None, 'coreschema must be installed to use `get_schema_fields()`'
+        return [
+            coreapi.Field(
+                name=self.before_query_param,
+                required=False,
+                location='query',
+                schema=coreschema.Integer(
+                    title='Before',
+                    description='Return the messages preceding this message id.'
+                )
+            ),
+            coreapi.Field(
+                name=self.after_query_param,
+                required=False,
+                location='query',
+                schema=coreschema.Integer(
+                    title='After',
+                    description='Return the messages following this message id.'
+                )
+            ),
+            coreapi.Field(
+                name=self.page_size_query_param,
+                required=False,
+                location='query',
+                schema=coreschema.Integer(
+                    title='Page size',
+                    description='Number of messages to return per page.'
+                )
+            ),
+        ]
@@ -1,7 +1,12 @@
 from rest_framework.permissions import BasePermission
 
+from message.membership import is_member
+
 
 class ConversationPermission(BasePermission):
     def has_permission(self, request, view):
-        conv_id = view.kwargs['conversation_pk']
-        return request.user.conversations.filter(id=conv_id).count()
+        try:
+            conv_id = int(view.kwargs['conversation_pk'])
+        except ValueError:
+            return False
+        return is_member(request.user.id, conv_id)
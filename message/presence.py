@@ -0,0 +1,31 @@
+import time
+
+from django.conf import settings
+from django.core.cache import cache
+
+
+def presence_key(user_id):
+    return f'presence:{user_id}'
+
+
+def mark_online(user_id):
+    """
+    Record a presence heartbeat of a user, who stays online for PRESENCE_TTL
+    seconds. Returns whether the user just came online.
+    """
+    key = presence_key(user_id)
+    now = time.time()
+    if cache.add(key, now, settings.PRESENCE_TTL):
+        return True
+    cache.set(key, now, settings.PRESENCE_TTL)
+    return False
+
+
+def get_presence(user_ids):
+    """
+    Return the last heartbeat timestamp of the online users among
+    `user_ids`, by user id.
+    """
+    keys = {presence_key(user_id): user_id for user_id in user_ids}
+    return {keys[key]: last_seen
+            for key, last_seen in cache.get_many(keys).items()}
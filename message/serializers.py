@@ -1,7 +1,18 @@
+from django.conf import settings
+from django.core.files.base import ContentFile
+from django.db import transaction
 from rest_framework import serializers
 from rest_framework.exceptions import ValidationError
-from message.models import Message, Conversation
-from message.fields import RelatedUserField
+from message import message_lists
+from message.conversation_lists import invalidate_conversations
+from message.models import (
+    Attachment,
+    Conversation,
+    Message,
+    MessageKey,
+    ReadCursor
+)
+from message.fields import BinaryField, RelatedUserField
 from core.models import User
 
 
@@ -9,6 +20,23 @@ class MessageSerializer(serializers.ModelSerializer):
     user = serializers.SerializerMethodField()
     created_at = serializers.SerializerMethodField()
     updated_at = serializers.SerializerMethodField()
+    binary_message = BinaryField(required=False, allow_null=True)
+    # Session key packets per recipient username, the message body being
+    # the ciphertext shared by every recipient
+    keys = serializers.DictField(
+        child=serializers.CharField(),
+        write_only=True,
+        required=False
+    )
+    # Session key packet of the reader
+    key_packet = serializers.SerializerMethodField()
+    attachments = serializers.PrimaryKeyRelatedField(
+        many=True,
+        required=False,
+        # Plain strings, for the channel layer and msgpack frames
+        pk_field=serializers.UUIDField(),
+        queryset=Attachment.objects.all()
+    )
 
     def get_user(self, obj):
         return obj.user.username
@@ -19,51 +47,218 @@ class MessageSerializer(serializers.ModelSerializer):
     def get_updated_at(self, obj):
         return obj.updated_at.timestamp()
 
+    def get_reader(self):
+        if self.context.get('websocket'):
+            return self.context.get('user')
+        return self.context['request'].user
+
+    def get_key_packet(self, obj):
+        reader = self.get_reader()
+        if reader is None:
+            return None
+        # Prefetched by the views for the reader
+        own_keys = getattr(obj, 'own_keys', None)
+        if own_keys is not None:
+            return own_keys[0].key_packet if own_keys else None
+        # Just created or updated
+        recipient_keys = getattr(obj, 'recipient_keys', None)
+        if recipient_keys is not None:
+            return recipient_keys.get(reader.id)
+        return (obj.keys.filter(recipient=reader)
+                        .values_list('key_packet', flat=True)
+                        .first())
+
+    def get_conversation_id(self):
+        if isinstance(self.instance, Message):
+            return self.instance.conversation_id
+        if self.context.get('websocket'):
+            return self.context['conversation'].pk
+        return int(self.context['view'].kwargs['conversation_pk'])
+
+    def validate_keys(self, keys):
+        # Members of the conversation are loaded once for all the messages
+        # validated with the same context
+        recipients = self.context.get('recipients')
+        if recipients is None:
+            recipients = self.context['recipients'] = dict(
+                User.objects
+                    .filter(conversations=self.get_conversation_id())
+                    .values_list('username', 'id'))
+
+        unknown = [username for username in keys if username not in recipients]
+        if unknown:
+            raise ValidationError(
+                f"{', '.join(unknown)} isn't part of the conversation")
+        return {recipients[username]: packet
+                for username, packet in keys.items()}
+
+    def validate_attachments(self, attachments):
+        conversation_id = self.get_conversation_id()
+        for attachment in attachments:
+            if attachment.conversation_id != conversation_id:
+                raise ValidationError(
+                    f"Attachment {attachment.id} doesn't belong to the "
+                    "conversation")
+            if not attachment.complete:
+                raise ValidationError(
+                    f'Attachment {attachment.id} is still being uploaded')
+        return attachments
+
     class Meta:
         model = Message
         fields = (
             'id',
             'user',
             'conversation',
+            'sequence',
             'message',
+            'binary_message',
+            'keys',
+            'key_packet',
+            'attachments',
             'created_at',
             'updated_at'
         )
         read_only_fields = ('conversation',)
 
     def create(self, validated_data):
+        keys = validated_data.pop('keys', {})
         # add user and conversation to validated_data (nested route)
         if not self.context.get('websocket'):
-            conversation = Conversation.objects.get(
-                pk=self.context["view"].kwargs["conversation_pk"])
-            validated_data["conversation"] = conversation
+            # ConversationPermission already checked the conversation
+            validated_data["conversation_id"] = int(
+                self.context["view"].kwargs["conversation_pk"])
             validated_data["user"] = self.context["request"].user
         else:
             validated_data["conversation"] = self.context["conversation"]
             validated_data["user"] = self.context["user"]
 
-        return super().create(validated_data)
+        with transaction.atomic():
+            message = super().create(validated_data)
+            MessageKey.objects.bulk_create(message.build_keys(keys))
+        return message
+
+    def update(self, instance, validated_data):
+        keys = validated_data.pop('keys', None)
+        with transaction.atomic():
+            message = super().update(instance, validated_data)
+            if keys is not None:
+                message.keys.all().delete()
+                MessageKey.objects.bulk_create(message.build_keys(keys))
+        return message
+
+
+def create_messages(conversation_id, items):
+    """
+    Insert validated `(user, validated_data)` messages of one conversation,
+    their key packets and attachment links with one bulk insert each.
+    """
+    messages = []
+    keys = []
+    links = []
+    for user, data in items:
+        data = dict(data)
+        recipient_keys = data.pop('keys', {})
+        attachments = data.pop('attachments', [])
+        message = Message(user=user, **data)
+        keys.extend(message.build_keys(recipient_keys))
+        # Saves a query per message when they are serialized
+        message._prefetched_objects_cache = {'attachments': attachments}
+        links.append((message, attachments))
+        messages.append(message)
+
+    Link = Message.attachments.through
+    with transaction.atomic():
+        Message.objects.create_batch(conversation_id, messages)
+        MessageKey.objects.bulk_create(keys)
+        Link.objects.bulk_create(
+            Link(message_id=message.pk, attachment_id=attachment.pk)
+            for message, attachments in links
+            for attachment in attachments
+        )
+        # Bulk inserts don't send post_save
+        invalidate_conversations([conversation_id])
+        message_lists.invalidate_users(
+            message.user_id for message in messages)
+    return messages
+
+
+class AttachmentSerializer(serializers.ModelSerializer):
+    complete = serializers.BooleanField(read_only=True)
+
+    class Meta:
+        model = Attachment
+        fields = ('id', 'conversation', 'size', 'received', 'complete')
+        read_only_fields = ('conversation', 'received')
+
+    def validate_size(self, size):
+        if size > settings.ATTACHMENT_MAX_SIZE:
+            raise ValidationError(
+                f'Attachments are limited to {settings.ATTACHMENT_MAX_SIZE} '
+                'bytes')
+        return size
+
+    def create(self, validated_data):
+        validated_data['conversation_id'] = int(
+            self.context['view'].kwargs['conversation_pk'])
+        validated_data['user'] = self.context['request'].user
+        attachment = Attachment(**validated_data)
+        # Chunks are appended to this empty file
+        attachment.file.save(None, ContentFile(b''), save=False)
+        attachment.save()
+        return attachment
 
 
 class ConversationUserSerializer(serializers.ModelSerializer):
     class Meta:
         model = User
-        fields = ('username', 'pgp_public')
+        # The key itself is fetched once from the key directory
+        fields = ('username', 'pgp_fingerprint')
 
 
 class ConversationReadSerializer(serializers.ModelSerializer):
     users = ConversationUserSerializer(many=True)
     last_user = serializers.SerializerMethodField()
+    last_activity = serializers.SerializerMethodField()
+    # Annotated by the view for the reader
+    read_sequence = serializers.IntegerField(read_only=True)
+    unread_count = serializers.SerializerMethodField()
+
+    def get_unread_count(self, obj):
+        return max(obj.last_sequence - obj.read_sequence, 0)
 
     def get_last_user(self, obj):
-        if obj.messages.count():
-            last_message = obj.messages.order_by('-created_at').last()
-            return last_message.user.username
+        if obj.last_user:
+            return obj.last_user.username
+        return None
+
+    def get_last_activity(self, obj):
+        if obj.last_activity:
+            return obj.last_activity.timestamp()
         return None
 
     class Meta:
         model = Conversation
-        fields = ('id', 'name', 'users', 'last_user')
+        fields = (
+            'id',
+            'name',
+            'users',
+            'last_user',
+            'last_message',
+            'message_count',
+            'last_activity',
+            'last_sequence',
+            'read_sequence',
+            'unread_count'
+        )
+
+
+class ReadCursorSerializer(serializers.ModelSerializer):
+    user = serializers.SlugRelatedField(slug_field='username', read_only=True)
+
+    class Meta:
+        model = ReadCursor
+        fields = ('user', 'read_sequence', 'delivered_sequence')
 
 
 class ConversationWriteSerializer(serializers.ModelSerializer):
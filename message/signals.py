@@ -0,0 +1,157 @@
+from django.core.signals import request_started
+from django.db import transaction
+from django.db.models.signals import (
+    m2m_changed,
+    post_delete,
+    post_save,
+    pre_delete
+)
+from django.dispatch import receiver
+
+from core.models import User
+from message import message_lists
+from message.conversation_lists import (
+    invalidate_conversations,
+    invalidate_users
+)
+from message.deletion import (
+    deletions,
+    flush_deletions,
+    flush_senders,
+    message_deleted
+)
+from message.groups import notify_users
+from message.membership import forget_memberships
+from message.models import (
+    Attachment,
+    Conversation,
+    Message,
+    MessageTombstone,
+    ReadCursor
+)
+
+
+@receiver(post_delete, sender=Message)
+def update_summary_on_delete(sender, instance, **kwargs):
+    message_deleted(instance)
+
+
+@receiver(pre_delete, sender=User)
+def collect_message_deletions(sender, instance, **kwargs):
+    # Messages of the user are deleted first, their tombstones are written
+    # in bulk once the user is gone
+    deletions.users.add(instance.pk)
+
+
+@receiver(post_delete, sender=User)
+def flush_message_deletions(sender, instance, **kwargs):
+    deletions.users.discard(instance.pk)
+    if not deletions.users and not deletions.depth:
+        flush_deletions()
+
+
+@receiver(request_started)
+def reset_message_deletions(sender, **kwargs):
+    # Left over by a deletion which failed in this thread
+    deletions.reset()
+
+
+@receiver(post_save, sender=Message)
+def update_lists_on_save(sender, instance, **kwargs):
+    # Message.save() updated the summary of the conversation
+    invalidate_conversations([instance.conversation_id])
+    message_lists.invalidate_users([instance.user_id])
+
+
+@receiver(post_save, sender=Conversation)
+def update_lists_on_rename(sender, instance, created, **kwargs):
+    if not created:
+        invalidate_conversations([instance.pk])
+
+
+@receiver(post_save, sender=User)
+def update_lists_on_key_change(sender, instance, update_fields=None,
+                               **kwargs):
+    # Conversation lists show the key fingerprint of the members
+    if update_fields is not None and 'pgp_public' not in update_fields:
+        return
+    invalidate_conversations(
+        instance.conversations.values_list('id', flat=True))
+
+
+@receiver(m2m_changed, sender=Conversation.users.through)
+def notify_membership_change(sender, instance, action, reverse, pk_set,
+                             **kwargs):
+    if action == 'pre_clear':
+        # pk_set isn't provided on clear, remember who is being removed
+        if reverse:
+            instance._cleared_pks = set(
+                instance.conversations.values_list('id', flat=True))
+        else:
+            instance._cleared_pks = set(
+                instance.users.values_list('id', flat=True))
+        return
+
+    if action == 'post_add':
+        event_type = 'conversation_joined'
+    elif action == 'post_remove':
+        event_type = 'conversation_left'
+    elif action == 'post_clear':
+        event_type = 'conversation_left'
+        pk_set = instance.__dict__.pop('_cleared_pks', set())
+    else:
+        return
+
+    # `instance` is a user on the reverse side (user.conversations)
+    if reverse:
+        changes = [(instance.pk, conversation_id)
+                   for conversation_id in pk_set]
+    else:
+        changes = [(user_id, instance.pk) for user_id in pk_set]
+
+    forget_memberships(changes)
+    if event_type == 'conversation_left':
+        for user_id, conversation_id in changes:
+            ReadCursor.objects.filter(conversation_id=conversation_id,
+                                      user_id=user_id).delete()
+    # Members which stay see the member list change too
+    if reverse:
+        invalidate_conversations(pk_set)
+    else:
+        invalidate_conversations([instance.pk])
+    invalidate_users(user_id for user_id, _ in changes)
+
+    def notify():
+        for user_id, conversation_id in changes:
+            notify_users([user_id], {
+                'type': event_type,
+                'conversation': conversation_id,
+            })
+    transaction.on_commit(notify)
+
+
+@receiver(pre_delete, sender=Conversation)
+def notify_conversation_deletion(sender, instance, **kwargs):
+    # The instance loses its pk once deleted
+    conversation_id = instance.pk
+    # Its messages are deleted with it: no tombstone nor summary update
+    deletions.conversations.add(conversation_id)
+    user_ids = list(instance.users.values_list('id', flat=True))
+    forget_memberships((user_id, conversation_id) for user_id in user_ids)
+    invalidate_users(user_ids)
+    transaction.on_commit(lambda: notify_users(user_ids, {
+        'type': 'conversation_left',
+        'conversation': conversation_id,
+    }))
+
+
+@receiver(post_delete, sender=Conversation)
+def delete_conversation_tombstones(sender, instance, **kwargs):
+    deletions.conversations.discard(instance.pk)
+    flush_senders()
+    MessageTombstone.objects.filter(conversation_id=instance.pk).delete()
+
+
+@receiver(post_delete, sender=Attachment)
+def delete_attachment_file(sender, instance, **kwargs):
+    instance.file.delete(save=False)
@@ -1,3 +1,41 @@
-from django.test import TestCase
+from rest_framework.test import APITestCase
 
-# Create your tests here.
+from core.models import User
+from message.models import Conversation, Message
+
+
+class ConversationListQueriesTest(APITestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(
+            'alice', 'password', pgp_public='alice-key')
+        self.client.force_authenticate(self.user)
+
+    def create_conversations(self, count):
+        start = Conversation.objects.count()
+        for i in range(start, start + count):
+            other = User.objects.create_user(
+                f'user-{i}', 'password', pgp_public=f'key-{i}')
+            conversation = Conversation.objects.create(name=f'conv-{i}')
+            conversation.users.add(self.user, other)
+            Message.objects.create(
+                user=other, conversation=conversation, message='hello')
+
+    def test_list_query_count_is_constant(self):
+        # conversations with their last sender + prefetched users
+        self.create_conversations(2)
+        with self.assertNumQueries(2):
+            self.client.get('/conversations/')
+
+        self.create_conversations(20)
+        with self.assertNumQueries(2):
+            response = self.client.get('/conversations/')
+        self.assertEqual(len(response.data), 22)
+
+    def test_last_user_is_latest_sender(self):
+        self.create_conversations(1)
+        conversation = Conversation.objects.get()
+        Message.objects.create(
+            user=self.user, conversation=conversation, message='hi')
+
+        response = self.client.get('/conversations/')
+        self.assertEqual(response.data[0]['last_user'], 'alice')
@@ -3,21 +3,32 @@ from django.urls.conf import include
 from rest_framework_nested import routers
 
 from message.views import (
+    AttachmentNestedViewSet,
+    AttachmentViewSet,
     ConversationViewSet,
     MessageNestedViewSet,
     MessageViewSet,
+    ReadCursorNestedViewSet,
+    WebsocketMetricsAPIView,
 )
 
 router = routers.DefaultRouter()
 router.register('conversations', ConversationViewSet, 'conversations')
 router.register('messages', MessageViewSet, 'messages')
+router.register('attachments', AttachmentViewSet, 'attachments')
 
 conversations_router = routers.NestedSimpleRouter(
     router, 'conversations', lookup='conversation')
 conversations_router.register(
     'messages', MessageNestedViewSet, basename='conversation-messages')
+conversations_router.register(
+    'cursors', ReadCursorNestedViewSet, basename='conversation-cursors')
+conversations_router.register(
+    'attachments', AttachmentNestedViewSet,
+    basename='conversation-attachments')
 
 urlpatterns = [
+    path('metrics/websockets/', WebsocketMetricsAPIView.as_view()),
     path('', include(router.urls)),
     path('', include(conversations_router.urls)),
 ]
@@ -1,13 +1,55 @@
+import re
+from django.conf import settings
+from django.db import transaction
+from django.db.models import (
+    Case,
+    F,
+    OuterRef,
+    Prefetch,
+    Subquery,
+    Value,
+    When
+)
+from django.db.models.functions import Coalesce, Greatest
+from django.http import FileResponse, StreamingHttpResponse
+from django.utils.http import parse_etags
+from rest_framework.decorators import action
+from rest_framework.exceptions import (
+    ParseError,
+    PermissionDenied,
+    ValidationError
+)
+from rest_framework.permissions import IsAdminUser
+from rest_framework.response import Response
+from rest_framework.views import APIView
 from rest_framework.viewsets import ModelViewSet, GenericViewSet
-from rest_framework import mixins
+from rest_framework import mixins, status
 
-from message.mixins import ReadWriteSerializerMixin
-from message.models import Conversation, Message
+from core.models import User
+from message import conversation_lists, message_lists
+from message.mixins import (
+    MessageChangesMixin,
+    MessagePackMixin,
+    ReadWriteSerializerMixin
+)
+from message.models import (
+    Attachment,
+    Conversation,
+    Message,
+    MessageTombstone,
+    ReadCursor
+)
+from message.outbound import metrics as outbound_metrics
+from message.pagination import MessageKeysetPagination
+from message.presence import get_presence
 from message.permissions import ConversationPermission
 from message.serializers import (
+    AttachmentSerializer,
     ConversationReadSerializer,
     ConversationWriteSerializer,
-    MessageSerializer
+    MessageSerializer,
+    ReadCursorSerializer,
+    create_messages
 )
 
 
@@ -16,21 +58,125 @@ class ConversationViewSet(ReadWriteSerializerMixin, ModelViewSet):
     write_serializer_class = ConversationWriteSerializer
 
     def get_queryset(self):
-        return Conversation.objects.filter(users=self.request.user)
+        read_sequence = (ReadCursor.objects
+                                   .filter(conversation=OuterRef('pk'),
+                                           user=self.request.user)
+                                   .values('read_sequence'))
+        return (Conversation.objects
+                            .filter(users=self.request.user)
+                            # Unread count = last_sequence - read_sequence.
+                            # Senders have read their own last message,
+                            # whether their cursor caught up or not.
+                            .annotate(read_sequence=Greatest(
+                                Coalesce(Subquery(read_sequence), 0),
+                                Case(
+                                    When(last_user=self.request.user,
+                                         then=F('last_sequence')),
+                                    default=Value(0)
+                                )
+                            ))
+                            .select_related('last_user')
+                            .defer('last_user__pgp_public',
+                                   'last_user__pgp_private')
+                            .prefetch_related(Prefetch(
+                                'users',
+                                queryset=User.objects.only(
+                                    'username', 'pgp_fingerprint')
+                            )))
+
+    def list(self, request, *args, **kwargs):
+        # The list is cached until one of its conversations changes, its
+        # version being its ETag
+        version = conversation_lists.get_version(request.user.id)
+        etag = f'"{version}"'
+        headers = {'ETag': etag}
+        if etag in parse_etags(request.headers.get('If-None-Match', '')):
+            return Response(status=status.HTTP_304_NOT_MODIFIED,
+                            headers=headers)
+
+        data = conversation_lists.get_list(request.user.id, version)
+        if data is None:
+            # Plain list: the serializer isn't cached along
+            data = list(super().list(request, *args, **kwargs).data)
+            conversation_lists.set_list(request.user.id, version, data)
+        return Response(data, headers=headers)
 
+    @action(detail=True, methods=['get'])
+    def presence(self, request, *args, **kwargs):
+        """
+        Online members of the conversation, with the timestamp of their
+        last presence heartbeat.
+        """
+        conversation = self.get_object()
+        members = dict(conversation.users.values_list('id', 'username'))
+        return Response([
+            {'user': members[user_id], 'last_seen': last_seen}
+            for user_id, last_seen in get_presence(members).items()
+        ])
 
-class MessageNestedViewSet(mixins.ListModelMixin,
+
+class MessageNestedViewSet(MessagePackMixin,
+                           MessageChangesMixin,
+                           mixins.ListModelMixin,
                            mixins.CreateModelMixin,
                            GenericViewSet):
     serializer_class = MessageSerializer
     permission_classes = (ConversationPermission,)
+    pagination_class = MessageKeysetPagination
 
     def get_queryset(self):
-        return Message.objects.filter(
+        # The reader only gets its own session key packet
+        return Message.objects.for_reader(self.request.user).filter(
             conversation=self.kwargs['conversation_pk'])
 
+    def get_list_version(self):
+        # The summary changes with every message created, edited or deleted
+        summary = (Conversation.objects
+                               .filter(pk=self.kwargs['conversation_pk'])
+                               .values('last_sequence', 'message_count',
+                                       'last_activity')
+                               .first())
+        if summary is None:
+            return '', None
+        last_activity = summary['last_activity']
+        return '%s:%s:%s' % (
+            summary['last_sequence'],
+            summary['message_count'],
+            last_activity.timestamp() if last_activity else '',
+        ), last_activity
+
+    def get_tombstones(self):
+        return MessageTombstone.objects.filter(
+            conversation_id=self.kwargs['conversation_pk'])
+
+    @action(detail=False, methods=['post'])
+    def bulk(self, request, *args, **kwargs):
+        """
+        Create a list of messages with a single insert, in list order.
+        """
+        # Other bodies than lists are rejected by the list serializer
+        if (isinstance(request.data, list) and
+                len(request.data) > settings.MESSAGE_BULK_MAX_SIZE):
+            raise ValidationError(
+                f'At most {settings.MESSAGE_BULK_MAX_SIZE} messages '
+                'can be created at once')
+
+        serializer = self.get_serializer(data=request.data, many=True)
+        serializer.is_valid(raise_exception=True)
+        messages = create_messages(
+            int(self.kwargs['conversation_pk']),
+            [(request.user, data) for data in serializer.validated_data]
+        )
+        return Response(
+            [{'id': message.id, 'sequence': message.sequence}
+             for message in messages],
+            status=status.HTTP_201_CREATED
+        )
+
 
-class MessageViewSet(mixins.RetrieveModelMixin,
+class MessageViewSet(MessagePackMixin,
+                     MessageChangesMixin,
+                     mixins.RetrieveModelMixin,
                      mixins.UpdateModelMixin,
                      mixins.DestroyModelMixin,
                      mixins.ListModelMixin,
@@ -38,4 +184,181 @@ class MessageViewSet(mixins.RetrieveModelMixin,
     serializer_class = MessageSerializer
 
     def get_queryset(self):
-        return Message.objects.filter(user=self.request.user)
+        return Message.objects.for_reader(self.request.user).filter(
+            user=self.request.user)
+
+    def get_list_version(self):
+        # Dropped whenever a message of the user changes, instead of
+        # aggregating all of them on every poll
+        return message_lists.get_version(self.request.user.id)
+
+    def get_tombstones(self):
+        return MessageTombstone.objects.filter(user_id=self.request.user.id)
+
+
+class ReadCursorNestedViewSet(mixins.ListModelMixin, GenericViewSet):
+    """
+        list:
+            Read and delivery cursors of the members of a conversation.
+            Their moves are then sent over the websockets.
+    """
+    serializer_class = ReadCursorSerializer
+    permission_classes = (ConversationPermission,)
+
+    def get_queryset(self):
+        return (ReadCursor.objects
+                          .filter(conversation=self.kwargs['conversation_pk'])
+                          .select_related('user')
+                          .only('user__username', 'read_sequence',
+                                'delivered_sequence'))
+
+
+class AttachmentNestedViewSet(mixins.CreateModelMixin, GenericViewSet):
+    serializer_class = AttachmentSerializer
+    permission_classes = (ConversationPermission,)
+
+    def get_queryset(self):
+        return Attachment.objects.filter(
+            conversation=self.kwargs['conversation_pk'])
+
+
+def read_blocks(file, length):
+    """
+    Yield `length` bytes of a file, one block at a time.
+    """
+    try:
+        while length > 0:
+            block = file.read(min(length, settings.ATTACHMENT_BLOCK_SIZE))
+            if not block:
+                break
+            length -= len(block)
+            yield block
+    finally:
+        file.close()
+
+
+class AttachmentViewSet(mixins.RetrieveModelMixin, GenericViewSet):
+    """
+        retrieve:
+            Upload progress of an attachment, to resume an interrupted
+            upload at `received` bytes.
+        upload:
+            Append a chunk to an attachment. The raw request body is
+            streamed to disk and must start at the `received` offset given
+            by the `Content-Range: bytes <start>-<end>/<size>` header.
+        download:
+            Stream a complete attachment, `Range: bytes=<start>-<end>`
+            requests being answered with partial content.
+    """
+    serializer_class = AttachmentSerializer
+    content_range_regex = re.compile(r'^bytes (\d+)-(\d+)/(\d+)$')
+    range_regex = re.compile(r'^bytes=(\d*)-(\d*)$')
+
+    def get_queryset(self):
+        return Attachment.objects.filter(conversation__users=self.request.user)
+
+    @action(detail=True, methods=['put'])
+    def upload(self, request, *args, **kwargs):
+        match = self.content_range_regex.match(
+            request.headers.get('Content-Range', ''))
+        if not match:
+            raise ParseError('A "Content-Range: bytes <start>-<end>/<size>" '
+                             'header is required')
+        start, end, size = (int(value) for value in match.groups())
+        if request.stream is None:
+            # No body at all
+            raise ValidationError(
+                'The request body is shorter than its Content-Range')
+
+        with transaction.atomic():
+            attachment = self.get_object()
+            if attachment.user_id != request.user.id:
+                raise PermissionDenied('Only the uploader can add chunks')
+            # Locks the upload of the attachment until the chunk is written
+            attachment = (Attachment.objects
+                                    .select_for_update()
+                                    .get(pk=attachment.pk))
+            if size != attachment.size or end < start or end >= size:
+                raise ValidationError('Invalid Content-Range')
+            if start != attachment.received:
+                return Response(
+                    self.get_serializer(attachment).data,
+                    status=status.HTTP_409_CONFLICT
+                )
+
+            length = end - start + 1
+            written = 0
+            with open(attachment.file.path, 'r+b') as file:
+                # Drop what an interrupted chunk may have left
+                file.truncate(start)
+                file.seek(start)
+                for block in read_blocks(request.stream, length):
+                    file.write(block)
+                    written += len(block)
+                if written != length:
+                    file.truncate(start)
+                    raise ValidationError(
+                        'The request body is shorter than its Content-Range')
+
+            attachment.received = start + written
+            attachment.save(update_fields=['received'])
+
+        return Response(self.get_serializer(attachment).data)
+
+    @action(detail=True, methods=['get'])
+    def download(self, request, *args, **kwargs):
+        attachment = self.get_object()
+        if not attachment.complete:
+            return Response(
+                self.get_serializer(attachment).data,
+                status=status.HTTP_409_CONFLICT
+            )
+
+        match = self.range_regex.match(request.headers.get('Range', ''))
+        if not match or match.groups() == ('', ''):
+            response = FileResponse(
+                attachment.file.open('rb'),
+                content_type='application/octet-stream'
+            )
+            response['Accept-Ranges'] = 'bytes'
+            return response
+
+        size = attachment.size
+        first, last = match.groups()
+        if first:
+            start = int(first)
+            end = min(int(last), size - 1) if last else size - 1
+        else:
+            # Suffix range: the last bytes of the file
+            start = max(size - int(last), 0)
+            end = size - 1
+        if start > end or start >= size:
+            response = Response(
+                status=status.HTTP_416_REQUESTED_RANGE_NOT_SATISFIABLE)
+            response['Content-Range'] = f'bytes */{size}'
+            return response
+
+        file = attachment.file.open('rb')
+        file.seek(start)
+        response = StreamingHttpResponse(
+            read_blocks(file, end - start + 1),
+            status=status.HTTP_206_PARTIAL_CONTENT,
+            content_type='application/octet-stream'
+        )
+        response['Content-Length'] = end - start + 1
+        response['Content-Range'] = f'bytes {start}-{end}/{size}'
+        response['Accept-Ranges'] = 'bytes'
+        return response
+
+
+class WebsocketMetricsAPIView(APIView):
+    """
+        get:
+            Outbound websocket queue counters of the serving process: open
+            connections, pending frames (depth, max_depth), frames sent,
+            coalesced and dropped, and clients disconnected on overflow.
+    """
+    permission_classes = (IsAdminUser,)
+
+    def get(self, request, *args, **kwargs):
+        return Response(outbound_metrics.snapshot())
@@ -88,7 +88,7 @@ WSGI_APPLICATION = 'pgp_messenger_back.wsgi.application'
 
 REST_FRAMEWORK = {
     'DEFAULT_AUTHENTICATION_CLASSES': (
-        'rest_framework_simplejwt.authentication.JWTAuthentication',
+        'core.authentication.CachedJWTAuthentication',
         'rest_framework.authentication.SessionAuthentication',
     ),
     'DEFAULT_PERMISSION_CLASSES': (
@@ -102,17 +102,87 @@ SIMPLE_JWT = {
     "ROTATE_REFRESH_TOKENS": True,
 }
 
-CHANNEL_LAYERS = {
-    'default': {
+# Verified access tokens cached by each process, for at most this many
+# seconds: users changed by another process are seen after that delay
+JWT_CACHE_TTL = 60
+JWT_CACHE_SIZE = 10000
+
+# 'redis' shares groups between worker processes and hosts, 'local' keeps
+# them in a single process (small deployments, tests) without a network hop
+CHANNEL_LAYER = 'redis'
+
+CHANNEL_LAYER_BACKENDS = {
+    'redis': {
         'BACKEND': 'channels_redis.core.RedisChannelLayer',
         'CONFIG': {
             "hosts": [('127.0.0.1', 6379)],
         },
     },
+    'local': {
+        'BACKEND': 'message.layers.LocalChannelLayer',
+        'CONFIG': {
+            # Pending messages per channel
+            'capacity': 1000,
+        },
+    },
+}
+
+CHANNEL_LAYERS = {
+    'default': CHANNEL_LAYER_BACKENDS[CHANNEL_LAYER],
 }
 
 TICKET_EXPIRE_TIME = 60
 
+# Public keys are cached by fingerprint, which changes with the key
+PGP_KEY_CACHE_TIMEOUT = 24 * 60 * 60
+
+# Cached conversation memberships are dropped when members change, and
+# expire after this many seconds anyway
+MEMBERSHIP_CACHE_TTL = 300
+
+# Lifetime of the cached conversation lists, which are also dropped as soon
+# as one of their conversations changes
+CONVERSATION_LIST_CACHE_TTL = 24 * 60 * 60
+
+# How long deleted messages are reported to clients syncing changes
+MESSAGE_TOMBSTONE_RETENTION = datetime.timedelta(days=30)
+
+# Changes younger than this are left to the next changed_since sync: rows
+# are stamped before their transaction commits, possibly after younger ones
+MESSAGE_CHANGES_LAG = datetime.timedelta(seconds=5)
+
+# Lifetime of the versions of the message lists of each user, which are also
+# dropped as soon as one of their messages changes
+MESSAGE_LIST_VERSION_TTL = 24 * 60 * 60
+
+# Maximum number of messages created by one bulk request
+MESSAGE_BULK_MAX_SIZE = 1000
+
+# Number of missed messages per frame when a websocket client resyncs
+WS_SYNC_BATCH_SIZE = 100
+
+# Websocket messages sent to a conversation within this many seconds are
+# stored and fanned out together (None disables batching)
+WS_BATCH_WINDOW = 0.005
+WS_BATCH_SIZE = 100
+
+# Frames pending for a websocket client beyond which its ephemeral frames
+# are dropped, then it is disconnected
+WS_OUTBOUND_QUEUE_SIZE = 256
+
+# Read and delivery cursor moves are written and fanned out at most once per
+# this many seconds
+READ_CURSOR_FLUSH_INTERVAL = 1.0
+
+# Users are online for PRESENCE_TTL seconds after a presence heartbeat, which
+# each connection sends at most once per PRESENCE_HEARTBEAT_INTERVAL
+PRESENCE_TTL = 60
+PRESENCE_HEARTBEAT_INTERVAL = 20
+
+# Repeated typing indicators of a connection are forwarded at most once per
+# this many seconds
+TYPING_EVENT_INTERVAL = 3
+
 CACHES = {
     "default": {
         "BACKEND": "django_redis.cache.RedisCache",
@@ -156,10 +226,28 @@ DATABASES = {
     'default': {
         'ENGINE': 'django.db.backends.sqlite3',
         'NAME': BASE_DIR / 'db.sqlite3',
+        # Keep connections open across database_sync_to_async calls
+        'CONN_MAX_AGE': 60,
     }
 }
 
 
+# Password hashing
+# https://docs.djangoproject.com/en/3.1/topics/auth/passwords/
+
+# Hashes made by the other hashers are upgraded on login
+PASSWORD_HASHERS = [
+    'django.contrib.auth.hashers.Argon2PasswordHasher',
+    'django.contrib.auth.hashers.PBKDF2PasswordHasher',
+    'django.contrib.auth.hashers.PBKDF2SHA1PasswordHasher',
+    'django.contrib.auth.hashers.BCryptSHA256PasswordHasher',
+]
+
+# Maximum number of passwords hashed or checked at once by a worker
+# (0 hashes them inline, in the request threads)
+PASSWORD_HASHING_CONCURRENCY = 4
+
+
 # Password validation
 # https://docs.djangoproject.com/en/3.1/ref/settings/#auth-password-validators
 
@@ -197,3 +285,14 @@ USE_TZ = True
 # https://docs.djangoproject.com/en/3.1/howto/static-files/
 
 STATIC_URL = '/static/'
+
+
+# Uploaded files (encrypted attachments)
+
+MEDIA_ROOT = BASE_DIR / 'media'
+
+# Maximum size of an attachment in bytes
+ATTACHMENT_MAX_SIZE = 100 * 1024 * 1024
+
+# Size of the blocks attachments are streamed to and from disk with
+ATTACHMENT_BLOCK_SIZE = 64 * 1024